@@ -1,5 +1,5 @@
 import streamlit as st
-import os, json, sqlite3, io, urllib.parse
+import os, json, sqlite3, io, gzip, shutil, urllib.parse
 import pandas as pd
 import numpy as np
 import plotly.graph_objects as go 
@@ -119,11 +119,17 @@ if service:
     # 下載資料庫 (如果本地不存在)
     if not os.path.exists(TARGET_DB):
         folder_id = st.secrets["GDRIVE_FOLDER_ID"]
-        query = f"'{folder_id}' in parents and name = '{TARGET_DB}' and trashed = false"
+        # 💡 main.py 以 gzip 壓縮上傳 (<檔名>.gz)，優先下載壓縮版再解壓，找不到時退回舊版未壓縮檔
+        query = f"'{folder_id}' in parents and (name = '{TARGET_DB}.gz' or name = '{TARGET_DB}') and trashed = false"
         results = service.files().list(q=query, fields="files(id, name)").execute()
-        files = results.get('files', [])
-        if files: 
-            download_file(service, files[0]['id'], TARGET_DB)
+        files = {f['name']: f['id'] for f in results.get('files', [])}
+        if f"{TARGET_DB}.gz" in files:
+            download_file(service, files[f"{TARGET_DB}.gz"], f"{TARGET_DB}.gz")
+            with gzip.open(f"{TARGET_DB}.gz", 'rb') as fi, open(TARGET_DB, 'wb') as fo:
+                shutil.copyfileobj(fi, fo, 1 << 20)
+            os.remove(f"{TARGET_DB}.gz")
+        elif TARGET_DB in files:
+            download_file(service, files[TARGET_DB], TARGET_DB)
 
     if os.path.exists(TARGET_DB):
         try:
@@ -0,0 +1,359 @@
+# -*- coding: utf-8 -*-
+"""
+downloader_base.py
+------------------
+HK / JP / KR / TW 下載器共用核心
+
+✔ 統一資料庫結構：stock_prices / stock_info 與增量回收設定
+✔ 統一同步流程：線程池併發下載，SQLite 寫入維持在主線程
+✔ 市場模組只需提供「清單函式」與「單檔 / 批次下載函式」兩個策略
+"""
+
+import os, time, random, sqlite3, requests
+import pandas as pd
+from datetime import timedelta
+from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# 💡 優先使用 orjson 解析 chart JSON，未安裝時退回標準庫 json
+try:
+    import orjson as _json
+except ImportError:
+    import json as _json
+
+def log(msg: str):
+    print(f"{pd.Timestamp.now():%H:%M:%S}: {msg}", flush=True)
+
+# ========== 1. 資料庫初始化 ==========
+# 💡 date 以 YYYYMMDD 整數儲存：比 TEXT 少約 7 bytes/列，主鍵索引與範圍比較也更快
+PRICES_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS stock_prices (
+        date INTEGER, symbol TEXT, open REAL, high REAL, 
+        low REAL, close REAL, volume INTEGER,
+        PRIMARY KEY (date, symbol)
+    )
+"""
+
+# 💡 主鍵以 date 開頭，依 symbol 查最後日期需要 (symbol, date) 索引才能直接定位
+SYMBOL_DATE_INDEX = "CREATE INDEX IF NOT EXISTS idx_symbol_date ON stock_prices (symbol, date DESC)"
+
+def to_date_int(date_str):
+    """'2024-01-02' -> 20240102"""
+    return int(str(date_str)[:10].replace('-', ''))
+
+def from_date_int(date_int):
+    """20240102 -> '2024-01-02'"""
+    s = str(date_int)
+    return f"{s[:4]}-{s[4:6]}-{s[6:8]}"
+
+def migrate_text_dates(conn):
+    """一次性升級：將舊版 TEXT 日期欄位重建為 INTEGER (YYYYMMDD)"""
+    cols = {row[1]: row[2] for row in conn.execute("PRAGMA table_info(stock_prices)")}
+    if cols.get('date', '').upper() != 'TEXT':
+        return
+    log("🔧 正在升級 stock_prices 結構：date 由 TEXT 轉為 INTEGER (YYYYMMDD)...")
+    conn.executescript(f"""
+        BEGIN;
+        ALTER TABLE stock_prices RENAME TO stock_prices_old;
+        {PRICES_SCHEMA};
+        INSERT INTO stock_prices (date, symbol, open, high, low, close, volume)
+            SELECT CAST(REPLACE(SUBSTR(date, 1, 10), '-', '') AS INTEGER), symbol, open, high, low, close, volume
+            FROM stock_prices_old;
+        DROP TABLE stock_prices_old;
+        COMMIT;
+    """)
+
+# 💡 WAL + synchronous=NORMAL：commit 不再每次 fsync 主檔，讀取端也不會阻塞寫入
+#    auto_vacuum 必須在切換 WAL 之前設定，新建資料庫時才會生效 (避免每次同步都要整檔 VACUUM)
+#    page_size 8KB：特徵計算的整表掃描頁數減半；與 auto_vacuum 相同只對新檔生效，舊檔由 main.py 以 VACUUM INTO 轉換
+#    mmap 1GB：讀取直接走記憶體映射，省去 read() 系統呼叫 (只是位址空間，不會預先佔用記憶體)
+PAGE_SIZE = 8192
+DB_PRAGMAS = f"""
+    PRAGMA page_size = {PAGE_SIZE};
+    PRAGMA auto_vacuum = INCREMENTAL;
+    PRAGMA journal_mode = WAL;
+    PRAGMA synchronous = NORMAL;
+    PRAGMA temp_store = MEMORY;
+    PRAGMA cache_size = -65536;
+    PRAGMA mmap_size = 1073741824;
+"""
+
+def open_db(db_path, timeout=60):
+    """開啟連線並套用批次寫入用的 PRAGMA；isolation_level=None，交易需自行 BEGIN / COMMIT"""
+    conn = sqlite3.connect(db_path, timeout=timeout, isolation_level=None)
+    conn.executescript(DB_PRAGMAS)
+    return conn
+
+def init_db(db_path):
+    conn = open_db(db_path)
+    try:
+        migrate_text_dates(conn)
+        conn.execute(PRICES_SCHEMA)
+        conn.execute(SYMBOL_DATE_INDEX)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS stock_info (
+                symbol TEXT PRIMARY KEY, name TEXT, sector TEXT, 
+                market TEXT, updated_at TEXT
+            )
+        """)
+    finally:
+        conn.close()
+
+def get_last_dates(conn):
+    """一次 GROUP BY 查詢取得所有代碼的最後日期，回傳 {symbol: YYYYMMDD}"""
+    return dict(conn.execute("SELECT symbol, MAX(date) FROM stock_prices GROUP BY symbol").fetchall())
+
+# ========== 2. 下載與重試策略 ==========
+RATE_LIMIT_STATUS = (401, 429)
+RATE_LIMIT_COOLDOWN = 10
+
+def backoff_delay(attempt, base=0.5, jitter=0.5, cap=30):
+    """指數退避加隨機抖動：base * 2**attempt + U(0, jitter)，上限 cap 秒"""
+    return min(cap, base * 2 ** attempt + random.uniform(0, jitter))
+
+def fetch_with_retry(fetch, max_retries=4):
+    """
+    執行 fetch() 並只針對暫時性錯誤重試，首次成功不會有任何等待
+    - 401/429 (限流)：額外冷卻約 10 秒再退避重試
+    - 5xx / 連線錯誤 / 逾時：依指數退避重試
+    - 404 / 查無價格：直接回傳 None，不浪費等待時間
+    - 其他 HTTP 錯誤 (400 / 403 等) 與例外：照常拋出，交由呼叫端記錄為下載失敗
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            return fetch()
+        except (requests.ConnectionError, requests.Timeout) as e:
+            last_exc = e
+            delay = backoff_delay(attempt)
+        except Exception as e:
+            last_exc = e
+            status = getattr(getattr(e, "response", None), "status_code", None)
+            if status in RATE_LIMIT_STATUS:
+                delay = RATE_LIMIT_COOLDOWN + backoff_delay(attempt)
+            elif status is not None and status >= 500:
+                delay = backoff_delay(attempt)
+            elif status == 404:
+                return None
+            else:
+                raise
+        if attempt == max_retries:
+            # 重試用盡：拋出最後一次的原始例外 (except 區塊外的裸 raise 已無作用中的例外)
+            raise last_exc
+        time.sleep(delay)
+
+# ========== 3. Yahoo chart API 直連 ==========
+CHART_URL = "https://query1.finance.yahoo.com/v8/finance/chart/{symbol}"
+# 💡 所有工作線程共用同一個連線池 (keep-alive)，避免每個線程各自重做 TLS 握手
+SESSION = requests.Session()
+SESSION.mount("https://", requests.adapters.HTTPAdapter(pool_connections=32, pool_maxsize=32))
+SESSION.headers["User-Agent"] = "Mozilla/5.0"
+
+def fetch_chart(symbol, start_date, end_date, timeout=15):
+    """
+    直接呼叫 Yahoo v8 chart API 下載單檔日線，略過 yfinance 的 DataFrame 組裝與調整邏輯
+    - 價格依 adjclose 還原權息，等同 yf.download(auto_adjust=True)
+    - 回傳 (date, symbol, OHLCV) tuple 列表，HTTP 錯誤以 requests.HTTPError 拋出
+    """
+    params = {
+        "period1": int(pd.Timestamp(start_date).timestamp()),
+        "period2": int(pd.Timestamp(end_date).timestamp()),
+        "interval": "1d", "events": "div,split", "includeAdjustedClose": "true",
+    }
+    r = SESSION.get(CHART_URL.format(symbol=symbol), params=params, timeout=timeout)
+    r.raise_for_status()
+    result = (_json.loads(r.content)["chart"]["result"] or [None])[0]
+    if not result or "timestamp" not in result:
+        return []
+
+    quote = result["indicators"]["quote"][0]
+    adjclose = result["indicators"].get("adjclose", [{}])[0].get("adjclose", quote["close"])
+    offset = result["meta"].get("gmtoffset", 0)
+    rows = []
+    for ts, o, h, l, c, adj, v in zip(result["timestamp"], quote["open"], quote["high"], quote["low"],
+                                      quote["close"], adjclose, quote["volume"]):
+        # 💡 成交量為 0 或缺值的列沒有分析價值，先剔除以縮小寫入量；成交量轉為整數以變長 INTEGER 儲存
+        if not v or None in (o, h, l, c, adj) or not c: continue
+        t = time.gmtime(ts + offset)
+        ratio = adj / c
+        rows.append((t.tm_year * 10000 + t.tm_mon * 100 + t.tm_mday, symbol,
+                     o * ratio, h * ratio, l * ratio, adj, int(v)))
+    return rows
+
+def download_chart(symbol, start_date, end_date, timeout=15):
+    """以 chart API 下載單檔 (共用連線池)，供 run_sync 逐檔提交；查無資料回傳 None，重試後仍失敗則拋出"""
+    return fetch_with_retry(lambda: fetch_chart(symbol, start_date, end_date, timeout=timeout)) or None
+
+# ========== 4. 批次寫入 ==========
+# 💡 多列 VALUES：7 欄 × 142 列 = 994 個參數，低於舊版 SQLite 的 999 上限
+INSERT_PREFIX = "INSERT INTO stock_prices (date, symbol, open, high, low, close, volume) VALUES "
+# 💡 UPSERT 取代 INSERT OR REPLACE：資料未變動的列不會被刪除重寫，增量同步時幾乎不產生髒頁
+UPSERT_CLAUSE = (
+    " ON CONFLICT(date, symbol) DO UPDATE SET"
+    " open = excluded.open, high = excluded.high, low = excluded.low,"
+    " close = excluded.close, volume = excluded.volume"
+    " WHERE excluded.close IS NOT stock_prices.close OR excluded.volume IS NOT stock_prices.volume"
+)
+UPSERT_SQL = INSERT_PREFIX + "(?, ?, ?, ?, ?, ?, ?)" + UPSERT_CLAUSE
+ROWS_PER_STATEMENT = 142
+FLUSH_ROWS = 1000
+COMMIT_ROWS = 10000
+VACUUM_FREELIST_RATIO = 0.25
+_FULL_INSERT = INSERT_PREFIX + ",".join(["(?,?,?,?,?,?,?)"] * ROWS_PER_STATEMENT) + UPSERT_CLAUSE
+
+def write_rows(conn, rows):
+    """將累積的 (date, symbol, OHLCV) tuple 以多列 UPSERT 寫入，每個 statement 最多 142 列"""
+    for i in range(0, len(rows), ROWS_PER_STATEMENT):
+        chunk = rows[i:i + ROWS_PER_STATEMENT]
+        sql = _FULL_INSERT if len(chunk) == ROWS_PER_STATEMENT else INSERT_PREFIX + ",".join(["(?,?,?,?,?,?,?)"] * len(chunk)) + UPSERT_CLAUSE
+        conn.execute(sql, [v for row in chunk for v in row])
+
+# ========== 5. 同步主流程 ==========
+def bounded_map(executor, fn, jobs, max_in_flight):
+    """
+    依完成順序產出 (job, future)，同時在途的工作最多 max_in_flight 個
+    💡 背壓：主線程寫入跟不上時不再提交新下載，已完成的結果不會無限堆積在記憶體
+    """
+    job_iter = iter(jobs)
+    pending = {}
+
+    def submit_next():
+        job = next(job_iter, None)
+        if job is not None:
+            pending[executor.submit(fn, job)] = job
+
+    for _ in range(max_in_flight):
+        submit_next()
+    while pending:
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            job = pending.pop(future)
+            submit_next()
+            yield job, future
+
+def optimize_db(conn):
+    """同步結束後的資料庫維護 (各市場下載器共用)
+    💡 PRAGMA optimize 只更新查詢統計，成本極低；VACUUM 會重寫整個資料庫檔案，
+       僅在空閒頁超過 25% (如舊版非增量回收的資料庫) 或明確要求 (VACUUM_AFTER_SYNC=1) 時執行"""
+    conn.execute("PRAGMA optimize")
+    page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+    freelist_count = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    if os.environ.get("VACUUM_AFTER_SYNC") == "1" or freelist_count > page_count * VACUUM_FREELIST_RATIO:
+        log(f"🧹 執行資料庫 VACUUM (空閒頁 {freelist_count}/{page_count})...")
+        # 先將 WAL 內容寫回主檔並截斷，VACUUM 才不會再複製一份 WAL
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        conn.execute("VACUUM")
+    else:
+        conn.execute("PRAGMA incremental_vacuum").fetchall()
+
+def run_sync(db_path, list_symbols, download_one, start_date, end_date,
+             market="", max_workers=8, on_success=None):
+    """
+    通用同步流程
+    - list_symbols(): 回傳清單，每筆 tuple 的第一個欄位為 symbol
+    - download_one(symbol, start, end): 回傳 (date, symbol, OHLCV) tuple 列表或 None
+    - on_success(conn, items): 選填，同步結束前於主線程以「所有成功項目」呼叫一次 (例如批次補寫 stock_info)
+    """
+    start_time = time.time()
+    init_db(db_path)
+
+    items = list_symbols()
+    if not items:
+        log(f"❌ 無法獲取 {market} 清單")
+        return {"success": 0, "total": 0, "has_changed": False}
+
+    log(f"🚀 開始 {market} 同步 | 區間: {start_date} ~ {end_date} | 線程數: {max_workers} | 目標: {len(items)} 檔")
+
+    success_count = 0
+    skip_count = 0
+    fail_count = 0
+    # 💡 關閉 Python sqlite3 的隱式交易，改為手動 BEGIN IMMEDIATE / COMMIT 控制整批寫入
+    conn = open_db(db_path)
+
+    # 💡 核心快取檢查邏輯：先在主線程決定每檔的起始日期
+    end_int = to_date_int(end_date)
+    last_dates = get_last_dates(conn)
+    tasks = []
+    for item in items:
+        last_date = last_dates.get(item[0])
+
+        actual_start = start_date
+        if last_date:
+            # 如果快取日期已達到或超過 end_date，則跳過
+            if last_date >= end_int:
+                skip_count += 1
+                continue
+            # 如果資料庫已有資料，從最後日期的下一天開始抓
+            actual_start = (pd.to_datetime(from_date_int(last_date)) + timedelta(days=1)).strftime('%Y-%m-%d')
+        tasks.append((item, actual_start))
+
+    # 💡 每檔一個工作單元：單檔重試退避時只佔用一個線程，不會拖住其他代碼
+    def run_job(task):
+        item, actual_start = task
+        return download_one(item[0], actual_start, end_date)
+
+    # 🟢 網路下載交給線程池，頻率由線程數控制；SQLite 寫入留在主線程
+    row_buffer = []
+    succeeded = []
+    rows_since_commit = 0
+    # 💡 首次全量載入時先移除次要索引，寫完再一次建立，比逐列維護索引快
+    initial_load = not last_dates
+    if initial_load:
+        conn.execute("DROP INDEX IF EXISTS idx_symbol_date")
+    # 💡 total_changes 只計入實際寫入的列 (UPSERT 內容未變動者不算)，用來判斷本次是否有新資料
+    changes_before = conn.total_changes
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            completed = bounded_map(executor, run_job, tasks, max_in_flight=max_workers * 4)
+
+            for (item, _), future in tqdm(completed, total=len(tasks), desc=f"{market}同步"):
+                try:
+                    rows = future.result()
+                except Exception as e:
+                    # 💡 重試後仍失敗的錯誤逐檔記錄，不中斷整體同步
+                    fail_count += 1
+                    log(f"⚠️ {item[0]} 下載失敗: {type(e).__name__}: {e}")
+                    continue
+
+                if rows:
+                    # 💡 跨檔累積到約 1000 列再一次寫入
+                    row_buffer.extend(rows)
+                    if len(row_buffer) >= FLUSH_ROWS:
+                        write_rows(conn, row_buffer)
+                        rows_since_commit += len(row_buffer)
+                        row_buffer.clear()
+                        # 💡 整個同步為單一交易，僅約每 1 萬列提交一次作為中斷時的保存點
+                        if rows_since_commit >= COMMIT_ROWS:
+                            conn.execute("COMMIT")
+                            conn.execute("BEGIN IMMEDIATE")
+                            rows_since_commit = 0
+                    succeeded.append(item)
+                    success_count += 1
+
+        write_rows(conn, row_buffer)
+        inserted_rows = conn.total_changes - changes_before
+        if on_success and succeeded:
+            on_success(conn, succeeded)
+        conn.execute("COMMIT")
+        if initial_load:
+            conn.execute(SYMBOL_DATE_INDEX)
+    except BaseException:
+        # 未提交的部分整批回滾，已提交的保存點不受影響
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        conn.close()
+        raise
+
+    unique_cnt = conn.execute("SELECT COUNT(DISTINCT symbol) FROM stock_prices").fetchone()[0]
+    optimize_db(conn)
+    conn.close()
+
+    duration = (time.time() - start_time) / 60
+    log(f"📊 {market} 同步完成 | 更新: {success_count} 檔 | 寫入: {inserted_rows} 列 | 跳過: {skip_count} 檔 | 失敗: {fail_count} 檔 | 資料庫總數: {unique_cnt} | 耗時: {duration:.1f} 分鐘")
+
+    return {
+        "success": success_count,
+        "total": len(items),
+        "inserted_rows": inserted_rows,
+        "has_changed": inserted_rows > 0
+    }
@@ -9,29 +9,37 @@ downloader_cn.py
 ✔ Yahoo Finance 格式轉換：自動處理 .SS 與 .SZ 標籤
 """
 
-import os, io, time, random, sqlite3, requests
+import os, time
+import numpy as np
 import pandas as pd
 import yfinance as yf
-from io import StringIO
 from datetime import datetime
 from tqdm import tqdm
 
+import downloader_base
+
 # ========== 1. 環境設定 ==========
 MARKET_CODE = "cn-share"
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DB_PATH = os.path.join(BASE_DIR, "cn_stock_warehouse.db")
 
+# 💡 寫入 SQL 於載入時建立一次 (共用 downloader_base 的 UPSERT，資料未變動的列不重寫)
+PRICE_COLS = ['date', 'symbol', 'open', 'high', 'low', 'close', 'volume']
+INSERT_SQL = downloader_base.UPSERT_SQL
+COMMIT_SYMBOLS = 500
+
 def log(msg: str):
     print(f"{pd.Timestamp.now():%H:%M:%S}: {msg}", flush=True)
 
 # ========== 2. 資料庫初始化 ==========
 def init_db():
-    conn = sqlite3.connect(DB_PATH)
+    # 💡 與其他市場共用 WAL + synchronous=NORMAL 等寫入 PRAGMA
+    conn = downloader_base.open_db(DB_PATH)
     try:
-        conn.execute('''CREATE TABLE IF NOT EXISTS stock_prices (
-                            date TEXT, symbol TEXT, open REAL, high REAL, 
-                            low REAL, close REAL, volume INTEGER,
-                            PRIMARY KEY (date, symbol))''')
+        # 💡 與其他市場一致：date 以 YYYYMMDD 整數儲存，舊版 TEXT 欄位一次性轉換
+        downloader_base.migrate_text_dates(conn)
+        conn.execute(downloader_base.PRICES_SCHEMA)
+        conn.execute(downloader_base.SYMBOL_DATE_INDEX)
         conn.execute('''CREATE TABLE IF NOT EXISTS stock_info (
                             symbol TEXT PRIMARY KEY, name TEXT, sector TEXT, market TEXT, updated_at TEXT)''')
         
@@ -52,30 +60,36 @@ def get_cn_stock_list_with_sector():
         # 獲取全體 A 股即時行情作為名單來源
         df_spot = ak.stock_zh_a_spot_em()
         
-        conn = sqlite3.connect(DB_PATH)
-        stock_list = []
-        
         # 核心板塊：主板、創業板、科創板
         valid_prefixes = ('000','001','002','003','300','301','600','601','603','605','688')
         
-        for _, row in df_spot.iterrows():
-            code = str(row['代码']).zfill(6)
-            if not code.startswith(valid_prefixes): continue
-            
-            # Yahoo Finance A股格式轉換
-            symbol = f"{code}.SS" if code.startswith('6') else f"{code}.SZ"
-            market = "SSE" if code.startswith('6') else "SZSE"
-            name = row['名称']
-            sector = "A-Share" # 預設分類
-            
-            conn.execute("""
+        # 💡 整欄向量化過濾與轉換，取代逐列 iterrows
+        codes = df_spot['代码'].astype(str).str.zfill(6)
+        mask = codes.str.startswith(valid_prefixes)
+        codes = codes[mask]
+        names = df_spot.loc[mask, '名称'].tolist()
+        
+        # Yahoo Finance A股格式轉換
+        is_sh = codes.str.startswith('6').to_numpy()
+        symbols = (codes + np.where(is_sh, ".SS", ".SZ")).tolist()
+        markets = np.where(is_sh, "SSE", "SZSE").tolist()
+        sector = "A-Share" # 預設分類
+        today = datetime.now().strftime("%Y-%m-%d")
+        
+        # 💡 整份名單以單一 executemany 在同一交易內寫入 (open_db 為 autocommit 模式，需明確 BEGIN)
+        conn = downloader_base.open_db(DB_PATH)
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany("""
                 INSERT OR REPLACE INTO stock_info (symbol, name, sector, market, updated_at) 
                 VALUES (?, ?, ?, ?, ?)
-            """, (symbol, name, sector, market, datetime.now().strftime("%Y-%m-%d")))
-            stock_list.append((symbol, name))
-            
-        conn.commit()
-        conn.close()
+            """, [(sym, name, sector, mk, today) for sym, name, mk in zip(symbols, names, markets)])
+            conn.execute("COMMIT")
+        finally:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            conn.close()
+        stock_list = list(zip(symbols, names))
         log(f"✅ 成功取得 A 股清單: {len(stock_list)} 檔")
         return stock_list
     except Exception as e:
@@ -93,26 +107,24 @@ def download_one_cn(symbol, start_date, end_date):
         try:
             # 💡 關閉多執行緒以維持中國市場長序列數據的穩定性
             df = yf.download(symbol, start=start_date, end=end_date, progress=False, 
-                             timeout=25, auto_adjust=True, threads=False)
+                             timeout=25, auto_adjust=True, threads=False, multi_level_index=False)
             
             if df is None or df.empty:
                 return None
             
-            # 處理 MultiIndex 結構
-            if isinstance(df.columns, pd.MultiIndex):
-                df.columns = df.columns.get_level_values(0)
-            
-            df.reset_index(inplace=True)
-            df.columns = [c.lower() for c in df.columns]
-            
-            date_col = 'date' if 'date' in df.columns else df.columns[0]
-            df['date_str'] = pd.to_datetime(df[date_col]).dt.tz_localize(None).dt.strftime('%Y-%m-%d')
-            
-            df_final = df[['date_str', 'open', 'high', 'low', 'close', 'volume']].copy()
-            df_final.columns = ['date', 'open', 'high', 'low', 'close', 'volume']
-            df_final['symbol'] = symbol
-            
-            return df_final
+            # 💡 OHLC 全為缺值的列直接剔除，成交量補 0 後轉為整數：SQLite 以變長 INTEGER 儲存，而非 8 bytes REAL
+            df = df.dropna(how='all', subset=['Open', 'High', 'Low', 'Close'])
+            # 💡 直接由 numpy 陣列組出最終表，省去 reset_index / 欄名轉小寫 / .copy() 等中間配置
+            idx = df.index.tz_localize(None) if df.index.tz is not None else df.index
+            return pd.DataFrame({
+                'date': (idx.year * 10000 + idx.month * 100 + idx.day).to_numpy(),
+                'open': df['Open'].to_numpy(),
+                'high': df['High'].to_numpy(),
+                'low': df['Low'].to_numpy(),
+                'close': df['Close'].to_numpy(),
+                'volume': df['Volume'].fillna(0).to_numpy(dtype='int64'),
+                'symbol': symbol,
+            })
         except:
             if attempt < max_retries:
                 time.sleep(3)
@@ -134,38 +146,64 @@ def run_sync(start_date="2024-01-01", end_date="2025-12-31"):
     log(f"🚀 開始 CN 數據同步 | 區間: {start_date} ~ {end_date} | 目標: {len(items)} 檔")
 
     success_count = 0
-    conn = sqlite3.connect(DB_PATH, timeout=60)
+    skip_count = 0
+    conn = downloader_base.open_db(DB_PATH)
+
+    # 💡 增量更新：一次 GROUP BY 取得各檔最後日期，已是最新者跳過，其餘只補自己的缺口
+    end_int = downloader_base.to_date_int(end_date)
+    last_dates = downloader_base.get_last_dates(conn)
     
     # 使用 tqdm 顯示同步進度
+    # 💡 整個同步迴圈包在單一交易中 (open_db 為 autocommit 模式)，每 500 檔提交一次作為中斷時的保存點
+    changes_before = conn.total_changes
     pbar = tqdm(items, desc="CN同步")
-    for symbol, name in pbar:
-        df_res = download_one_cn(symbol, start_date, end_date)
-        
-        if df_res is not None:
-            # 使用 INSERT OR REPLACE 進行 upsert
-            df_res.to_sql('stock_prices', conn, if_exists='append', index=False, 
-                          method=lambda table, conn, keys, data_iter: 
-                          conn.executemany(f"INSERT OR REPLACE INTO {table.name} ({', '.join(keys)}) VALUES ({', '.join(['?']*len(keys))})", data_iter))
-            success_count += 1
-        
-        # 中國市場伺服器較敏感，建議維持 0.05s 以上延遲  
-        time.sleep(0.05)
-    
-    conn.commit()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        for symbol, name in pbar:
+            last_date = last_dates.get(symbol)
+            if last_date and last_date >= end_int:
+                skip_count += 1
+                continue
+            sym_start = start_date
+            if last_date:
+                sym_start = (pd.to_datetime(downloader_base.from_date_int(last_date)) + pd.Timedelta(days=1)).strftime('%Y-%m-%d')
+            df_res = download_one_cn(symbol, sym_start, end_date)
+            
+            if df_res is not None:
+                # 使用 INSERT OR REPLACE 進行 upsert
+                conn.executemany(INSERT_SQL, df_res[PRICE_COLS].itertuples(index=False, name=None))
+                success_count += 1
+                if success_count % COMMIT_SYMBOLS == 0:
+                    conn.execute("COMMIT")
+                    conn.execute("BEGIN IMMEDIATE")
+            
+            # 中國市場伺服器較敏感，建議維持 0.05s 以上延遲  
+            time.sleep(0.05)
+        conn.execute("COMMIT")
+    except BaseException:
+        # 未提交的部分整批回滾，已提交的保存點不受影響
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        conn.close()
+        raise
+    finally:
+        pbar.close()
+    # 💡 只計入實際寫入的列 (UPSERT 內容未變動者不算)
+    inserted_rows = conn.total_changes - changes_before
 
     # 優化與統計
-    log("🧹 執行資料庫優化 (VACUUM)...")
-    conn.execute("VACUUM")
+    downloader_base.optimize_db(conn)
     db_count = conn.execute("SELECT COUNT(DISTINCT symbol) FROM stock_info").fetchone()[0]
     conn.close()
 
     duration = (time.time() - start_time) / 60
-    log(f"📊 同步完成！庫存總數: {db_count} | 更新成功: {success_count} | 費時: {duration:.1f} 分鐘")
+    log(f"📊 同步完成！庫存總數: {db_count} | 更新成功: {success_count} | 寫入: {inserted_rows} 列 | 已是最新而跳過: {skip_count} | 費時: {duration:.1f} 分鐘")
     
     return {
         "success": success_count,
         "total": len(items),
-        "has_changed": success_count > 0
+        "inserted_rows": inserted_rows,
+        "has_changed": inserted_rows > 0
     }
 
 if __name__ == "__main__":
@@ -2,20 +2,21 @@
 """
 downloader_jp.py
 ----------------
-日股資料下載器（穩定單執行緒連動版）
+日股資料下載器（多執行緒連動版）
 
 ✔ 支援外部日期傳參：由 main.py 統一指定下載區間
-✔ 單執行緒循環：確保 JPX 大量標的下載時數據 100% 準確
+✔ 多執行緒下載：線程池併發抓取，SQLite 寫入維持在主線程
 ✔ 自動處理 .xls：解決 JPX 官方清單讀取問題
 """
 
-import os, sys, sqlite3, time, random, io, subprocess
+import os, sys, sqlite3, io, subprocess
 import pandas as pd
-import yfinance as yf
 from datetime import datetime
-from tqdm import tqdm
 import requests
 
+import downloader_base
+from downloader_base import log, fetch_chart, fetch_with_retry
+
 # =====================================================
 # 1. 環境設定
 # =====================================================
@@ -23,44 +24,28 @@ MARKET_CODE = "jp-share"
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DB_PATH = os.path.join(BASE_DIR, "jp_stock_warehouse.db")
 
-def log(msg: str):
-    print(f"{pd.Timestamp.now():%H:%M:%S}: {msg}", flush=True)
-
 # =====================================================
-# 2. Excel 支援與資料庫初始化
+# 2. Excel 支援
 # =====================================================
 def ensure_excel_tool():
+    """優先使用 Rust 實作的 calamine 讀取 Excel，未安裝時退回 xlrd"""
+    try:
+        import python_calamine
+        return "calamine"
+    except ImportError:
+        pass
     try:
         import xlrd
     except ImportError:
         log("🔧 安裝 xlrd 以支援 JPX 官方表格...")
         subprocess.run([sys.executable, "-m", "pip", "install", "-q", "xlrd"])
-
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    try:
-        conn.execute("""
-            CREATE TABLE IF NOT EXISTS stock_prices (
-                date TEXT, symbol TEXT, open REAL, high REAL, 
-                low REAL, close REAL, volume INTEGER,
-                PRIMARY KEY (date, symbol)
-            )
-        """)
-        conn.execute("""
-            CREATE TABLE IF NOT EXISTS stock_info (
-                symbol TEXT PRIMARY KEY, name TEXT, sector TEXT, 
-                market TEXT, updated_at TEXT
-            )
-        """)
-        conn.commit()
-    finally:
-        conn.close()
+    return None
 
 # =====================================================
 # 3. 取得 JPX 股票清單
 # =====================================================
 def get_jp_stock_list():
-    ensure_excel_tool()
+    engine = ensure_excel_tool()
     url = "https://www.jpx.co.jp/english/markets/statistics-equities/misc/tvdivq0000001vg2-att/data_e.xls"
     headers = {
         "User-Agent": "Mozilla/5.0",
@@ -72,7 +57,7 @@ def get_jp_stock_list():
     try:
         r = requests.get(url, headers=headers, timeout=30)
         r.raise_for_status()
-        df = pd.read_excel(io.BytesIO(r.content))
+        df = pd.read_excel(io.BytesIO(r.content), engine=engine)
     except Exception as e:
         log(f"❌ 下載失敗: {e}")
         return []
@@ -121,88 +106,18 @@ def download_one_jp(symbol, start_date, end_date):
     """
     接收來自 run_sync 的日期區間進行下載
     """
-    max_retries = 2
-    
-    for attempt in range(max_retries + 1):
-        try:
-            # 💡 核心修正：使用傳入的日期參數，並維持 threads=False 穩定性
-            df = yf.download(symbol, start=start_date, end=end_date, progress=False, 
-                             auto_adjust=True, threads=False, timeout=30)
-
-            if df is None or df.empty:
-                if attempt < max_retries:
-                    time.sleep(2)
-                    continue
-                return None
-
-            if isinstance(df.columns, pd.MultiIndex):
-                df.columns = df.columns.get_level_values(0)
-
-            df = df.reset_index()
-            df.columns = [c.lower() for c in df.columns]
-
-            if "date" in df.columns:
-                df["date"] = pd.to_datetime(df["date"]).dt.tz_localize(None).dt.strftime("%Y-%m-%d")
-
-            df_final = df[["date", "open", "high", "low", "close", "volume"]].copy()
-            df_final["symbol"] = symbol
-            return df_final
-        except Exception:
-            if attempt < max_retries:
-                time.sleep(3)
-                continue
-            return None
+    # 💡 僅限流 (401/429) 與 5xx 會退避重試，查無資料直接回傳 None
+    return fetch_with_retry(lambda: fetch_chart(symbol, start_date, end_date, timeout=30), max_retries=2) or None
 
 # =====================================================
 # 5. 主流程 (對齊 main.py 呼叫介面)
 # =====================================================
-def run_sync(start_date="2024-01-01", end_date="2025-12-31"):
+def run_sync(start_date="2024-01-01", end_date="2025-12-31", max_workers=8):
     """
     由 main.py 呼叫，傳入全域統一的日期範圍
     """
-    start_time = time.time()
-    init_db()
-
-    items = get_jp_stock_list()
-    if not items:
-        return {"success": 0, "has_changed": False}
-
-    log(f"🚀 開始日股同步 | 區間: {start_date} ~ {end_date} | 目標: {len(items)} 檔")
-
-    success_count = 0
-    conn = sqlite3.connect(DB_PATH, timeout=60)
-    
-    # 單執行緒循環
-    pbar = tqdm(items, desc="JP同步")
-    for symbol, name in pbar:
-        # 將傳入的日期轉交給下載核心
-        df_res = download_one_jp(symbol, start_date, end_date)
-        
-        if df_res is not None:
-            df_res.to_sql('stock_prices', conn, if_exists='append', index=False, 
-                          method=lambda table, conn, keys, data_iter: 
-                          conn.executemany(f"INSERT OR REPLACE INTO {table.name} ({', '.join(keys)}) VALUES ({', '.join(['?']*len(keys))})", data_iter))
-            success_count += 1
-        
-        # 🟢 防止觸發 Yahoo 頻率限制
-        time.sleep(0.05)
-
-    conn.commit()
-    
-    # 統計與優化
-    log("🧹 執行資料庫 VACUUM...")
-    conn.execute("VACUUM")
-    total_in_db = conn.execute("SELECT COUNT(DISTINCT symbol) FROM stock_info").fetchone()[0]
-    conn.close()
-
-    duration = (time.time() - start_time) / 60
-    log(f"📊 JP 同步完成 | 更新成功: {success_count}/{len(items)} | 費時 {duration:.1f} 分")
-
-    return {
-        "success": success_count,
-        "total": total_in_db,
-        "has_changed": success_count > 0
-    }
+    return downloader_base.run_sync(DB_PATH, get_jp_stock_list, download_one_jp, start_date, end_date,
+                                    market="JP", max_workers=max_workers)
 
 if __name__ == "__main__":
     # 手動執行測試
@@ -9,29 +9,69 @@ downloader_us.py
 ✔ 結構對齊：完全支援全局自動化連動機制
 """
 
-import os, io, time, random, sqlite3, requests, re
+import os, sys, time, sqlite3, re
+from collections import deque
 import pandas as pd
 import yfinance as yf
-from io import StringIO
+from yfinance import shared as yf_shared
+from yfinance.exceptions import YFRateLimitError
 from datetime import datetime
 from tqdm import tqdm
 
+import downloader_base
+
 # ========== 1. 環境判斷與參數設定 ==========
 MARKET_CODE = "us-share"
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DB_PATH = os.path.join(BASE_DIR, "us_stock_warehouse.db")
 
+# 💡 寫入 SQL 於載入時建立一次 (共用 downloader_base 的 UPSERT，資料未變動的列不重寫)
+INSERT_SQL = downloader_base.UPSERT_SQL
+# 💡 全量重建：先灌入無主鍵的暫存表 stock_prices_new，成功後才建唯一索引並在同一交易內換掉舊表；
+#    中途失敗時舊的 stock_prices (含主鍵) 完全不受影響
+STAGING_TABLE = "stock_prices_new"
+BULK_INSERT_SQL = downloader_base.INSERT_PREFIX.replace("stock_prices", STAGING_TABLE, 1) + "(?, ?, ?, ?, ?, ?, ?)"
+UNKEYED_PRICES_SCHEMA = f"""
+    CREATE TABLE {STAGING_TABLE} (
+        date INTEGER, symbol TEXT, open REAL, high REAL, 
+        low REAL, close REAL, volume INTEGER
+    )
+"""
+PRICES_UNIQUE_INDEX = "CREATE UNIQUE INDEX IF NOT EXISTS ix_prices_date_sym ON stock_prices (date, symbol)"
+
+def swap_in_staging(conn):
+    """於單一交易內以暫存表取代 stock_prices，並建立唯一索引 (UPSERT 的 ON CONFLICT 依據) 與查詢索引"""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute("DROP TABLE IF EXISTS stock_prices")
+        conn.execute(f"ALTER TABLE {STAGING_TABLE} RENAME TO stock_prices")
+        conn.execute(PRICES_UNIQUE_INDEX)
+        conn.execute(downloader_base.SYMBOL_DATE_INDEX)
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+# 💡 名單過濾規則於載入時編譯一次：代號須為英數字，5 碼以上且以 R/W/U 結尾者為權證/附權/單位
+_SYMBOL_RE = re.compile(r"^[A-Z0-9]+$")
+_BAD_SUFFIX_RE = re.compile(r"^[A-Z0-9]{4,}[RWU]$")
+_EXCLUDE_KW = re.compile(r"Warrant|Right|Preferred|Unit|ETF|Index|Index-linked", re.I)
+_BAD_SECTOR = frozenset({'', 'nan', 'n/a'})
+# 💡 yfinance 對「區間內無價格 / 可能已下市」也會記錄錯誤，這類屬正常結果，不需逐檔補抓
+_NO_DATA_RE = re.compile(r"delisted|no price data|no timezone|no data found", re.I)
+
 def log(msg: str):
     print(f"{pd.Timestamp.now():%H:%M:%S}: {msg}", flush=True)
 
 # ========== 2. 資料庫初始化 ==========
 def init_db():
-    conn = sqlite3.connect(DB_PATH)
+    # 💡 與其他市場共用 WAL + synchronous=NORMAL 等寫入 PRAGMA
+    conn = downloader_base.open_db(DB_PATH)
     try:
-        conn.execute('''CREATE TABLE IF NOT EXISTS stock_prices (
-                            date TEXT, symbol TEXT, open REAL, high REAL, 
-                            low REAL, close REAL, volume INTEGER,
-                            PRIMARY KEY (date, symbol))''')
+        # 💡 與其他市場一致：date 以 YYYYMMDD 整數儲存，舊版 TEXT 欄位一次性轉換
+        downloader_base.migrate_text_dates(conn)
+        conn.execute(downloader_base.PRICES_SCHEMA)
+        conn.execute(downloader_base.SYMBOL_DATE_INDEX)
         conn.execute('''CREATE TABLE IF NOT EXISTS stock_info (
                             symbol TEXT PRIMARY KEY, name TEXT, sector TEXT, market TEXT, updated_at TEXT)''')
         
@@ -56,36 +96,36 @@ def get_us_stock_list_official():
     }
 
     try:
-        r = requests.get(url, headers=headers, timeout=30)
+        # 💡 走 downloader_base 共用的連線池 Session (keep-alive)
+        r = downloader_base.SESSION.get(url, headers=headers, timeout=30)
         rows = r.json()['data']['rows']
         
-        conn = sqlite3.connect(DB_PATH)
-        stock_list = []
-        exclude_kw = re.compile(r"Warrant|Right|Preferred|Unit|ETF|Index|Index-linked", re.I)
+        stock_list, info_rows = [], []
+        today = datetime.now().strftime("%Y-%m-%d")
 
         for row in rows:
             symbol = str(row.get('symbol', '')).strip().upper()
+            name = str(row.get('name', 'Unknown')).strip()
             
             # 💡 核心過濾：排除衍生品
-            if not symbol or not symbol.isalnum(): continue
-            if len(symbol) > 4 and (symbol.endswith('R') or symbol.endswith('W') or symbol.endswith('U')):
+            if not _SYMBOL_RE.match(symbol) or _BAD_SUFFIX_RE.match(symbol) or _EXCLUDE_KW.search(name):
                 continue
             
-            name = str(row.get('name', 'Unknown')).strip()
-            if exclude_kw.search(name): continue
-            
             sector = str(row.get('sector', 'Unknown')).strip()
             market = str(row.get('exchange', 'Unknown')).strip()
             
-            if not sector or sector.lower() in ['nan', 'n/a', '']: sector = "Unknown"
+            if sector.lower() in _BAD_SECTOR: sector = "Unknown"
 
-            conn.execute("""
+            info_rows.append((symbol, name, sector, market, today))
+            stock_list.append((symbol, name))
+
+        # 💡 整份名單以單一 executemany 在同一交易內寫入
+        conn = sqlite3.connect(DB_PATH)
+        with conn:
+            conn.executemany("""
                 INSERT OR REPLACE INTO stock_info (symbol, name, sector, market, updated_at) 
                 VALUES (?, ?, ?, ?, ?)
-            """, (symbol, name, sector, market, datetime.now().strftime("%Y-%m-%d")))
-            stock_list.append((symbol, name))
-            
-        conn.commit()
+            """, info_rows)
         conn.close()
         log(f"✅ 美股清單導入成功: {len(stock_list)} 檔")
         return stock_list
@@ -94,45 +134,106 @@ def get_us_stock_list_official():
         return []
 
 # ========== 4. 下載核心 (支援傳入日期) ==========
+# 💡 Yahoo 單次請求建議上限約 20 檔
+BATCH_SIZE = 20
+# 💡 累積約 500 檔的資料列後才一次 executemany 寫入
+FLUSH_SYMBOLS = 500
+# 💡 滑動視窗節流：最近 20 次請求若落在 1 秒內才等待，平時不睡眠
+THROTTLE_WINDOW = 20
+_recent_requests = deque(maxlen=THROTTLE_WINDOW)
+
+def throttle():
+    if len(_recent_requests) == THROTTLE_WINDOW:
+        span = time.monotonic() - _recent_requests[0]
+        if span < 1:
+            time.sleep(1 - span)
+    _recent_requests.append(time.monotonic())
+
+def index_to_date_int(index):
+    """DatetimeIndex -> YYYYMMDD 整數陣列 (整欄運算，不經過逐列 strftime)"""
+    idx = index.tz_localize(None) if index.tz is not None else index
+    return (idx.year * 10000 + idx.month * 100 + idx.day).to_numpy()
+
+def to_price_rows(df, symbol, dates=None):
+    """將 yfinance 單一標的 OHLCV 轉為 stock_prices 的 (date, symbol, O, H, L, C, V) tuple 列表；無有效資料時回傳 None
+    dates: 選填，批次下載時各標的共用同一個索引，日期只需轉換一次"""
+    if dates is None:
+        dates = index_to_date_int(df.index)
+    # 💡 OHLC 全為缺值的列直接剔除，成交量補 0 後轉為整數：SQLite 以變長 INTEGER 儲存，而非 8 bytes REAL
+    keep = df[['Open', 'High', 'Low', 'Close']].notna().any(axis=1).to_numpy()
+    if not keep.any():
+        return None
+    # 💡 各欄維持獨立的 numpy 陣列，.tolist() 一次轉為 Python 純量後 zip 成列，
+    #    不再組中間 DataFrame 再 itertuples；sqlite3 也無法直接綁定 numpy 整數
+    n = int(keep.sum())
+    return list(zip(
+        dates[keep].tolist(),
+        [symbol] * n,
+        df['Open'].to_numpy()[keep].tolist(),
+        df['High'].to_numpy()[keep].tolist(),
+        df['Low'].to_numpy()[keep].tolist(),
+        df['Close'].to_numpy()[keep].tolist(),
+        df['Volume'].fillna(0).to_numpy(dtype='int64')[keep].tolist(),
+    ))
+
+def download_batch_us(symbols, start_date, end_date):
+    """一次請求下載一批標的，回傳 ({symbol: rows}, 下載失敗需逐檔補抓的標的)
+    - 查無資料 (已是最新 / 已下市) 的標的兩者皆不列入"""
+    throttle()
+    try:
+        df = yf.download(symbols, start=start_date, end=end_date, group_by='ticker', progress=False,
+                         auto_adjust=True, threads=True, timeout=30)
+    except Exception:
+        return {}, list(symbols)
+    # 💡 yf.download 每次呼叫會重設 shared._ERRORS，記錄本批各標的的失敗原因
+    errors = getattr(yf_shared, '_ERRORS', {})
+    failed = [sym for sym in symbols if sym in errors and not _NO_DATA_RE.search(str(errors[sym]))]
+    if df is None or df.empty:
+        return {}, failed
+
+    fetched = {}
+    tickers = set(df.columns.get_level_values(0))
+    dates = index_to_date_int(df.index)
+    for sym in symbols:
+        if sym not in tickers:
+            # 批次結果缺少該欄且未記錄為查無資料，視為下載失敗
+            if sym not in errors:
+                failed.append(sym)
+            continue
+        rows = to_price_rows(df[sym], sym, dates)
+        if rows:
+            fetched[sym] = rows
+    return fetched, failed
+
 def download_one_us(symbol, start_date, end_date):
     """
     從 Yahoo Finance 下載特定區間的資料
     """
-    max_retries = 1
+    max_retries = 2
     
     for attempt in range(max_retries + 1):
+        throttle()
         try:
-            # 💡 使用從 run_sync 傳來的 start_date 與 end_date
-            df = yf.download(symbol, start=start_date, end=end_date, progress=False, 
-                             auto_adjust=True, threads=False, timeout=30)
+            # 💡 yf.download 會吞掉限流錯誤；Ticker.history 則一律拋出 YFRateLimitError，才能針對 429 退避
+            df = yf.Ticker(symbol).history(start=start_date, end=end_date, auto_adjust=True, timeout=30)
             
             if df is None or df.empty:
                 return None
-            
-            if isinstance(df.columns, pd.MultiIndex):
-                df.columns = df.columns.get_level_values(0)
-            
-            df.reset_index(inplace=True)
-            df.columns = [c.lower() for c in df.columns]
-            
-            date_col = 'date' if 'date' in df.columns else df.columns[0]
-            df['date_str'] = pd.to_datetime(df[date_col]).dt.tz_localize(None).dt.strftime('%Y-%m-%d')
-            
-            df_final = df[['date_str', 'open', 'high', 'low', 'close', 'volume']].copy()
-            df_final.columns = ['date', 'open', 'high', 'low', 'close', 'volume']
-            df_final['symbol'] = symbol
-            
-            return df_final
+            return to_price_rows(df, symbol)
+        except YFRateLimitError:
+            # 僅在被限流時才等待：冷卻 + 指數退避與隨機抖動
+            delay = downloader_base.RATE_LIMIT_COOLDOWN + downloader_base.backoff_delay(attempt)
         except Exception:
-            if attempt < max_retries:
-                time.sleep(3)
-                continue
+            delay = downloader_base.backoff_delay(attempt)
+        if attempt == max_retries:
             return None
+        time.sleep(delay)
 
 # ========== 5. 主流程 (對齊 main.py 的呼叫介面) ==========
-def run_sync(start_date="2024-01-01", end_date="2025-12-31"):
+def run_sync(start_date="2024-01-01", end_date="2025-12-31", full_rebuild=False):
     """
     接收 main.py 傳送來的日期參數
+    - full_rebuild: 自 start_date 全量重抓至暫存表，全部寫入成功後才建索引並取代 stock_prices
     """
     start_time = time.time()
     init_db()
@@ -144,40 +245,101 @@ def run_sync(start_date="2024-01-01", end_date="2025-12-31"):
     log(f"🚀 開始美股同步 | 區間: {start_date} ~ {end_date} | 目標: {len(items)} 檔")
 
     success_count = 0
-    conn = sqlite3.connect(DB_PATH, timeout=60)
-    
-    # 採用單執行緒循環下載
-    pbar = tqdm(items, desc="US同步")
-    for symbol, name in pbar:
-        # 將日期參數傳遞給下載核心
-        df_res = download_one_us(symbol, start_date, end_date)
-        
-        if df_res is not None:
-            df_res.to_sql('stock_prices', conn, if_exists='append', index=False, 
-                          method=lambda table, conn, keys, data_iter: 
-                          conn.executemany(f"INSERT OR REPLACE INTO {table.name} ({', '.join(keys)}) VALUES ({', '.join(['?']*len(keys))})", data_iter))
-            success_count += 1
-            
-        # 極小延遲，避免 API 頻率限制
-        time.sleep(0.01)
+    pending, pending_symbols = [], 0
+    conn = downloader_base.open_db(DB_PATH)
+    if full_rebuild:
+        log(f"🧱 全量重建 stock_prices：先寫入無索引的 {STAGING_TABLE}，完成後再建索引並替換")
+        conn.executescript(f"BEGIN; DROP TABLE IF EXISTS {STAGING_TABLE}; {UNKEYED_PRICES_SCHEMA}; COMMIT;")
+    write_sql = BULK_INSERT_SQL if full_rebuild else INSERT_SQL
+
+    def flush():
+        nonlocal pending_symbols
+        if pending:
+            conn.executemany(write_sql, pending)
+            pending.clear()
+        pending_symbols = 0
     
-    conn.commit()
+    # 💡 增量更新：一次 GROUP BY 取得各檔最後日期，已是最新者跳過，其餘從隔天開始抓
+    end_int = downloader_base.to_date_int(end_date)
+    last_dates = {} if full_rebuild else downloader_base.get_last_dates(conn)
+    # 💡 首次載入時先移除次要索引，寫完再一次建立，比逐列維護索引快
+    initial_load = not last_dates and not full_rebuild
+    if initial_load:
+        conn.execute("DROP INDEX IF EXISTS idx_symbol_date")
+    by_start = {}
+    skip_count = 0
+    for symbol, _ in items:
+        last_date = last_dates.get(symbol)
+        if last_date and last_date >= end_int:
+            skip_count += 1
+            continue
+        sym_start = start_date
+        if last_date:
+            sym_start = (pd.to_datetime(downloader_base.from_date_int(last_date)) + pd.Timedelta(days=1)).strftime('%Y-%m-%d')
+        by_start.setdefault(sym_start, []).append(symbol)
+
+    # 💡 同一起始日的標的每 20 檔一次請求，批次中下載失敗的標的再逐檔補抓一次 (查無資料者不補抓)
+    jobs = [(sym_start, symbols[i:i + BATCH_SIZE])
+            for sym_start, symbols in by_start.items()
+            for i in range(0, len(symbols), BATCH_SIZE)]
+    pbar = tqdm(total=len(items) - skip_count, desc="US同步")
+    # 💡 整個同步迴圈包在單一交易中 (open_db 為 autocommit 模式)，每 500 檔提交一次以控制 WAL 大小
+    changes_before = conn.total_changes
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        for sym_start, batch in jobs:
+            fetched, failed = download_batch_us(batch, sym_start, end_date)
+            for symbol in failed:
+                rows = download_one_us(symbol, sym_start, end_date)
+                if rows:
+                    fetched[symbol] = rows
+
+            for rows in fetched.values():
+                pending.extend(rows)
+            success_count += len(fetched)
+            pending_symbols += len(fetched)
+            if pending_symbols >= FLUSH_SYMBOLS:
+                flush()
+                conn.execute("COMMIT")
+                conn.execute("BEGIN IMMEDIATE")
+            pbar.update(len(batch))
+        flush()
+        conn.execute("COMMIT")
+        # 💡 只計入實際寫入的列 (UPSERT 內容未變動者不算)
+        inserted_rows = conn.total_changes - changes_before
+        if full_rebuild:
+            swap_in_staging(conn)
+        elif initial_load:
+            conn.execute(downloader_base.SYMBOL_DATE_INDEX)
+        if full_rebuild or initial_load:
+            conn.execute("ANALYZE")
+    except BaseException:
+        # 未提交的部分整批回滾，已提交的批次不受影響；全量重建則捨棄暫存表，舊表維持原狀
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        if full_rebuild:
+            conn.execute(f"DROP TABLE IF EXISTS {STAGING_TABLE}")
+        conn.close()
+        raise
+    finally:
+        pbar.close()
     
-    log("🧹 執行資料庫 VACUUM...")
-    conn.execute("VACUUM")
+    downloader_base.optimize_db(conn)
     db_info_count = conn.execute("SELECT COUNT(DISTINCT symbol) FROM stock_info").fetchone()[0]
     conn.close()
 
     duration = (time.time() - start_time) / 60
     log(f"📊 同步完成！費時: {duration:.1f} 分鐘")
-    log(f"✅ 更新成功: {success_count} / {len(items)}")
+    log(f"✅ 更新成功: {success_count} / {len(items)} | 寫入: {inserted_rows} 列 | 已是最新而跳過: {skip_count}")
     
     return {
         "success": success_count,
         "total": db_info_count,
-        "has_changed": success_count > 0
+        "inserted_rows": inserted_rows,
+        "has_changed": inserted_rows > 0
     }
 
 if __name__ == "__main__":
-    # 手動執行時預設下載近期資料
-    run_sync(start_date="2024-01-01", end_date=datetime.now().strftime("%Y-%m-%d"))
+    # 手動執行時預設下載近期資料；加上 --full-rebuild 則全量重建 stock_prices
+    run_sync(start_date="2024-01-01", end_date=datetime.now().strftime("%Y-%m-%d"),
+             full_rebuild="--full-rebuild" in sys.argv)
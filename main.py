@@ -1,18 +1,34 @@
 # -*- coding: utf-8 -*-
-import os, sys, sqlite3, json, time, socket, io
+import os, sys, sqlite3, json, time, socket, io, importlib, shutil, gzip, hashlib
+import multiprocessing as mp
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 from datetime import datetime, timedelta
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload, MediaIoBaseDownload
+import google_auth_httplib2, httplib2
+from google.auth.transport.requests import AuthorizedSession
+from googleapiclient.http import MediaFileUpload
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
 
+from downloader_base import open_db, PAGE_SIZE
+
 # 💡 載入環境變數
 load_dotenv() 
 socket.setdefaulttimeout(600)
 
 # 💡 環境變數讀取
 GDRIVE_FOLDER_ID = os.environ.get('GDRIVE_FOLDER_ID')
+GZIP_SUFFIX = ".gz"
+DIRECT_UPLOAD_LIMIT = 50 * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 32 * 1024 * 1024
+RANGE_DOWNLOAD_MIN = 64 * 1024 * 1024
+RANGE_DOWNLOAD_PARTS = 4
+# 💡 預設只上傳 .gz；仍需直接讀取未壓縮 .db 的下游 (如 Alpha-Data-Cleaning-Lab) 可設 UPLOAD_PLAIN_DB=1 一併上傳
+UPLOAD_PLAIN_DB = os.environ.get('UPLOAD_PLAIN_DB', '').lower() in ('1', 'true', 'yes')
 
 # 💡 導入特徵加工模組
 try:
@@ -21,8 +37,7 @@ except ImportError:
     print("⚠️ 系統提示：找不到 processor.py，將跳過特徵工程。")
     process_market_data = None
 
-import downloader_tw, downloader_us, downloader_cn, downloader_hk, downloader_jp, downloader_kr
-
+# 💡 下載模組不在此一次全部載入；run_market 依 MARKET_MODULES 以 importlib 按需載入
 # ========== 💡 快取輔助函式 ==========
 
 def get_db_last_date(db_path):
@@ -30,103 +45,286 @@ def get_db_last_date(db_path):
     if not os.path.exists(db_path):
         return None
     try:
-        conn = sqlite3.connect(db_path)
+        conn = open_db(db_path)
         # 抓取資料庫中最後一筆日期
         res = conn.execute("SELECT MAX(date) FROM stock_prices").fetchone()
         conn.close()
-        return res[0] if res[0] else None
+        if not res[0]:
+            return None
+        # 各市場皆以 YYYYMMDD 整數儲存日期，統一轉回 YYYY-MM-DD；非數字者為尚未遷移的舊版 TEXT 日期，原樣回傳
+        last = str(res[0])
+        return f"{last[:4]}-{last[4:6]}-{last[6:8]}" if last.isdigit() else last
     except:
         return None
 
+def vacuum_into(conn, db_path):
+    """💡 以 VACUUM INTO 直接寫出壓縮後的新檔 (只寫一次)，回傳暫存檔路徑，由呼叫端關閉連線後再替換原檔；
+    一般 VACUUM 會先寫暫存資料庫、再經由日誌整份寫回原檔，I/O 約為兩倍"""
+    tmp_path = db_path + ".vacuum"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn.execute("VACUUM INTO ?", (tmp_path,))
+    return tmp_path
+
 # ========== Google Drive 服務函式 ==========
 
-def get_drive_service():
+def get_drive_credentials():
     env_json = os.environ.get('GDRIVE_SERVICE_ACCOUNT')
+    if not env_json:
+        print("❌ 錯誤：找不到環境變數 GDRIVE_SERVICE_ACCOUNT")
+        return None
+    info = json.loads(env_json)
+    return service_account.Credentials.from_service_account_info(
+        info, scopes=['https://www.googleapis.com/auth/drive']
+    )
+
+# 💡 每個程序快取一個 Drive service，所有 files().* 呼叫共用同一條 keep-alive 連線；
+#    以 pid 區分，fork 出的子程序不會沿用父程序的 socket
+_DRIVE_SERVICE = (None, None)
+
+def get_drive_service(fresh=False):
+    global _DRIVE_SERVICE
+    pid, service = _DRIVE_SERVICE
+    if service is not None and pid == os.getpid() and not fresh:
+        return service
     try:
-        if env_json:
-            info = json.loads(env_json)
-            creds = service_account.Credentials.from_service_account_info(
-                info, scopes=['https://www.googleapis.com/auth/drive']
-            )
-            return build('drive', 'v3', credentials=creds, cache_discovery=False)
-        else:
-            print("❌ 錯誤：找不到環境變數 GDRIVE_SERVICE_ACCOUNT")
+        creds = get_drive_credentials()
+        if not creds:
             return None
+        http = google_auth_httplib2.AuthorizedHttp(creds, http=httplib2.Http(timeout=600))
+        service = build('drive', 'v3', http=http, cache_discovery=False)
+        _DRIVE_SERVICE = (os.getpid(), service)
+        return service
     except Exception as e:
         print(f"❌ Drive 服務初始化失敗: {e}")
         return None
 
-def download_db_from_drive(service, file_name):
-    if not GDRIVE_FOLDER_ID: return False
+# 💡 每個程序共用一個 AuthorizedSession (keep-alive)，與 Drive service 相同以 pid 區分；
+#    連線池大小對齊 Range 並行下載數，429 / 5xx 由連線層自動退避重試 (下載皆為冪等 GET)
+_AUTH_SESSION = (None, None)
+DOWNLOAD_RETRY = Retry(total=5, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=["GET"])
+
+def get_auth_session():
+    global _AUTH_SESSION
+    pid, session = _AUTH_SESSION
+    if session is None or pid != os.getpid():
+        session = AuthorizedSession(get_drive_credentials())
+        session.mount("https://", HTTPAdapter(pool_maxsize=RANGE_DOWNLOAD_PARTS, max_retries=DOWNLOAD_RETRY))
+        _AUTH_SESSION = (os.getpid(), session)
+    return session
+
+def list_folder(service):
+    """💡 一次列出雲端資料夾內所有檔案，回傳 {檔名: {'id', 'size', 'sha256'}}，取代每個檔案各自 files().list / get 查詢
+    (appProperties 與清單一併取回，上傳前的內容雜湊比對不需再逐檔呼叫 files().get)"""
+    if not GDRIVE_FOLDER_ID: return {}
+    query = f"'{GDRIVE_FOLDER_ID}' in parents and trashed = false"
+    folder_ids, page_token = {}, None
+    try:
+        while True:
+            results = service.files().list(q=query, fields="nextPageToken, files(id, name, size, appProperties)",
+                                           pageSize=1000, pageToken=page_token).execute()
+            for f in results.get('files', []):
+                folder_ids.setdefault(f['name'], drive_entry(f))
+            page_token = results.get('nextPageToken')
+            if not page_token: return folder_ids
+    except Exception as e:
+        print(f"⚠️ 無法列出雲端資料夾: {e}")
+        return None
+
+# 💡 未傳入 folder_ids 的呼叫端 (如 only_feature.py) 共用本程序內的資料夾對照表，只列一次
+_DRIVE_INDEX = None
+
+def drive_index(service):
+    global _DRIVE_INDEX
+    if _DRIVE_INDEX is None:
+        _DRIVE_INDEX = list_folder(service)
+    return _DRIVE_INDEX
+
+def drive_entry(f):
+    return {'id': f['id'], 'size': int(f.get('size') or 0), 'sha256': (f.get('appProperties') or {}).get('sha256')}
+
+def find_file(service, file_name, folder_ids=None):
+    """回傳 {'id', 'size', 'sha256'} 或 None；有快取對照表時直接查表，列出資料夾失敗時才單獨查詢一次"""
+    if folder_ids is None:
+        folder_ids = drive_index(service)
+    if folder_ids is not None:
+        return folder_ids.get(file_name)
     query = f"name = '{file_name}' and '{GDRIVE_FOLDER_ID}' in parents and trashed = false"
+    items = service.files().list(q=query, fields="files(id, size, appProperties)").execute().get('files', [])
+    return drive_entry(items[0]) if items else None
+
+def find_file_id(service, file_name, folder_ids=None):
+    entry = find_file(service, file_name, folder_ids)
+    return entry['id'] if entry else None
+
+def download_db_from_drive(service, file_name, folder_ids=None):
+    if not GDRIVE_FOLDER_ID: return False
     try:
-        results = service.files().list(q=query, fields="files(id)").execute()
-        items = results.get('files', [])
-        if not items: return False
+        # 💡 優先下載 gzip 壓縮版，找不到時退回舊版未壓縮檔案
+        entry = find_file(service, file_name + GZIP_SUFFIX, folder_ids)
+        compressed = entry is not None
+        if not compressed:
+            entry = find_file(service, file_name, folder_ids)
+        if not entry: return False
+        file_id = entry['id']
+
+        # 💡 本機已有檔案 (如 Actions cache 還原) 且內容雜湊與雲端 appProperties 相同：直接沿用，免整檔下載
+        if entry['sha256'] and os.path.exists(file_name) and file_sha256(file_name) == entry['sha256']:
+            print(f"✨ 本機 {file_name} 與雲端快取一致，略過下載")
+            return True
         
-        file_id = items[0]['id']
-        print(f"📡 從雲端同步快取檔案: {file_name}")
-        request = service.files().get_media(fileId=file_id)
-        with io.FileIO(file_name, 'wb') as fh:
-            downloader = MediaIoBaseDownload(fh, request, chunksize=5*1024*1024)
-            done = False
-            while not done: _, done = downloader.next_chunk()
+        print(f"📡 從雲端同步快取檔案: {file_name}{GZIP_SUFFIX if compressed else ''}")
+        # 💡 單一 HTTP 請求串流寫檔，取代 MediaIoBaseDownload 每 5 MB 一次的分段請求
+        url = f"https://www.googleapis.com/drive/v3/files/{file_id}?alt=media"
+        if entry['size'] >= RANGE_DOWNLOAD_MIN:
+            # 💡 大檔以多段 Range 請求並行下載到暫存檔，再一次解壓
+            part_file = file_name + (GZIP_SUFFIX if compressed else ".part")
+            download_ranges(url, part_file, entry['size'])
+            if compressed:
+                with gzip.open(part_file, 'rb') as src, open(file_name, 'wb') as fh:
+                    shutil.copyfileobj(src, fh, 1 << 20)
+                os.remove(part_file)
+            else:
+                os.replace(part_file, file_name)
+            return True
+        with get_auth_session().get(url, stream=True, timeout=600) as r:
+            r.raise_for_status()
+            r.raw.decode_content = True
+            src = gzip.GzipFile(fileobj=r.raw) if compressed else r.raw
+            with open(file_name, 'wb') as fh:
+                shutil.copyfileobj(src, fh, 1 << 20)
         return True
     except: return False
 
-def upload_db_to_drive(service, file_path, max_retries=3):
+def download_ranges(url, dest, size, parts=RANGE_DOWNLOAD_PARTS):
+    """將檔案切成 parts 段，各段以 Range 請求並行下載並寫入 dest 的對應位移"""
+    session = get_auth_session()
+    step = -(-size // parts)
+    with open(dest, 'wb') as fh:
+        fh.truncate(size)
+
+    def fetch(start):
+        end = min(start + step, size) - 1
+        headers = {'Range': f'bytes={start}-{end}'}
+        with session.get(url, headers=headers, stream=True, timeout=600) as r:
+            r.raise_for_status()
+            if r.status_code != 206:
+                raise IOError(f"Range 請求未被接受 (HTTP {r.status_code})")
+            # 💡 每個執行緒各自開檔並 seek 到自己的位移，不共用檔案指標
+            with open(dest, 'r+b') as fh:
+                fh.seek(start)
+                for chunk in r.iter_content(1 << 20):
+                    fh.write(chunk)
+
+    with ThreadPoolExecutor(parts) as ex:
+        list(ex.map(fetch, range(0, size, step)))
+
+def upload_db_to_drive(service, file_path, max_retries=3, folder_ids=None):
     """
     上傳資料庫到 Google Drive，加入重試機制
+    - .db 檔先以 gzip 壓縮後上傳為 <檔名>.gz，下載端 (download_db_from_drive) 會自動解壓
+    - UPLOAD_PLAIN_DB 開啟時才另外上傳未壓縮的 <檔名>.db (預設關閉，避免上傳量不減反增)
+    - folder_ids: 選填，list_folder() 的結果；新建檔案後會回寫 file_id
     """
     if not GDRIVE_FOLDER_ID or not os.path.exists(file_path): 
         print(f"⚠️ 無法上傳 {file_path}: 缺少 GDRIVE_FOLDER_ID 或檔案不存在")
         return False
-    
+    if not file_path.endswith('.db'):
+        return upload_file_to_drive(service, file_path, 'application/octet-stream', max_retries, folder_ids)
+
+    # 💡 以原始 .db 的 SHA-256 判斷內容是否變動，與雲端 appProperties 記錄相同時直接略過上傳
+    #    (gzip 標頭含時間戳，壓縮檔本身的雜湊每次都不同，因此比對未壓縮檔)
+    file_name = os.path.basename(file_path)
+    gz_path = file_path + GZIP_SUFFIX
+    digest = file_sha256(file_path)
+    remote_gz = remote_plain = None
+    try:
+        remote_gz = find_file(service, file_name + GZIP_SUFFIX, folder_ids)
+        if UPLOAD_PLAIN_DB:
+            remote_plain = find_file(service, file_name, folder_ids)
+    except Exception as e:
+        print(f"⚠️ 無法讀取雲端檔案雜湊，照常上傳: {e}")
+
+    success = True
+    if remote_gz and remote_gz['sha256'] == digest:
+        print(f"✨ {file_name} 內容未變動，略過上傳")
+    else:
+        # 💡 SQLite 檔案壓縮率高；level 1 幾乎不耗 CPU，卻能大幅減少上傳位元組
+        with open(file_path, 'rb') as fi, gzip.open(gz_path, 'wb', compresslevel=1) as fo:
+            shutil.copyfileobj(fi, fo, 1 << 20)
+        try:
+            success = upload_file_to_drive(service, gz_path, 'application/gzip', max_retries, folder_ids,
+                                           app_properties={'sha256': digest})
+        finally:
+            os.remove(gz_path)
+
+    # 💡 明確開啟 UPLOAD_PLAIN_DB 時才同步未壓縮的 .db (同樣以雜湊略過未變動者)；
+    #    預設關閉，下游應改讀 .gz，雲端舊有的 .db 不再更新
+    if UPLOAD_PLAIN_DB and not (remote_plain and remote_plain['sha256'] == digest):
+        success = upload_file_to_drive(service, file_path, 'application/x-sqlite3', max_retries, folder_ids,
+                                       app_properties={'sha256': digest}) and success
+    return success
+
+def file_sha256(file_path):
+    h = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def execute_upload(request, resumable):
+    if not resumable:
+        return request.execute()
+    response = None
+    while response is None:
+        status, response = request.next_chunk()
+        if status:
+            print(f"  上傳進度: {int(status.progress() * 100)}%")
+    return response
+
+def upload_file_to_drive(service, file_path, mimetype, max_retries=3, folder_ids=None, app_properties=None):
+    """上傳單一檔案 (同名檔案存在則更新)，失敗時重試；app_properties 會一併寫入檔案中繼資料"""
+    if folder_ids is None:
+        folder_ids = drive_index(service)
     file_name = os.path.basename(file_path)
     file_size = os.path.getsize(file_path)
     
     print(f"📤 準備上傳 {file_name} (大小: {file_size/1024/1024:.2f} MB)")
     
-    # 檢查檔案大小，如果太大需要調整 chunksize
-    chunk_size = 5 * 1024 * 1024  # 5MB
-    if file_size > 100 * 1024 * 1024:  # 如果大於 100MB
-        chunk_size = 10 * 1024 * 1024  # 使用 10MB chunks
+    # 💡 小檔案以單一請求直接上傳 (非 resumable)，大檔案才走 resumable 並使用 32MB 分段
+    resumable = file_size >= DIRECT_UPLOAD_LIMIT
     
     for attempt in range(max_retries):
         try:
             # 每次重試都重新創建 media
             media = MediaFileUpload(
                 file_path, 
-                mimetype='application/x-sqlite3', 
-                resumable=True,
-                chunksize=chunk_size
+                mimetype=mimetype, 
+                resumable=resumable,
+                chunksize=UPLOAD_CHUNK_SIZE
             )
             
-            query = f"name = '{file_name}' and '{GDRIVE_FOLDER_ID}' in parents and trashed = false"
-            results = service.files().list(q=query, fields="files(id)").execute()
-            items = results.get('files', [])
+            file_id = find_file_id(service, file_name, folder_ids)
             
-            if items:
+            if file_id:
                 print(f"🔄 嘗試更新現有檔案 (第 {attempt+1}/{max_retries} 次嘗試)")
-                file_id = items[0]['id']
                 
                 # 更新檔案
                 request = service.files().update(
                     fileId=file_id,
+                    body={'appProperties': app_properties} if app_properties else None,
                     media_body=media,
                     fields='id'
                 )
                 
                 # 執行更新請求
-                response = None
-                while response is None:
-                    status, response = request.next_chunk()
-                    if status:
-                        print(f"  上傳進度: {int(status.progress() * 100)}%")
+                response = execute_upload(request, resumable)
                 
             else:
                 print(f"🔄 嘗試創建新檔案 (第 {attempt+1}/{max_retries} 次嘗試)")
                 meta = {'name': file_name, 'parents': [GDRIVE_FOLDER_ID]}
+                if app_properties:
+                    meta['appProperties'] = app_properties
                 
                 # 創建新檔案
                 request = service.files().create(
@@ -136,18 +334,20 @@ def upload_db_to_drive(service, file_path, max_retries=3):
                 )
                 
                 # 執行創建請求
-                response = None
-                while response is None:
-                    status, response = request.next_chunk()
-                    if status:
-                        print(f"  上傳進度: {int(status.progress() * 100)}%")
+                response = execute_upload(request, resumable)
             
+            if folder_ids is not None:
+                folder_ids[file_name] = {'id': response['id'], 'size': os.path.getsize(file_path), 'sha256': (app_properties or {}).get('sha256')}
             print(f"✅ {file_name} 上傳成功!")
             return True
             
         except Exception as e:
             error_msg = str(e)
             print(f"⚠️ {file_name} 上傳失敗 (第 {attempt+1}/{max_retries} 次): {error_msg}")
+
+            # 💡 快取的 file_id 已失效 (雲端檔案被刪除)：移出對照表，下次重試改為建立新檔
+            if getattr(getattr(e, 'resp', None), 'status', None) == 404 and folder_ids is not None:
+                folder_ids.pop(file_name, None)
             
             # 檢查是否為 SSL 相關錯誤
             if "SSL" in error_msg or "EOF" in error_msg or "SSL23" in error_msg:
@@ -156,7 +356,7 @@ def upload_db_to_drive(service, file_path, max_retries=3):
                 
                 # 嘗試重新獲取服務
                 try:
-                    service = get_drive_service()
+                    service = get_drive_service(fresh=True)
                     if not service:
                         print("  ❌ 無法重新建立 Google Drive 服務")
                         continue
@@ -171,84 +371,159 @@ def upload_db_to_drive(service, file_path, max_retries=3):
 
 # ========== 主程式邏輯 ==========
 
-def main():
-    target_market = sys.argv[1].lower() if len(sys.argv) > 1 else 'all'
-    module_map = {
-        'tw': downloader_tw, 'us': downloader_us, 'cn': downloader_cn, 
-        'hk': downloader_hk, 'jp': downloader_jp, 'kr': downloader_kr
-    }
-    
-    markets_to_run = [target_market] if target_market in module_map else list(module_map.keys())
+# 💡 市場代碼 → 下載模組名稱；子程序內才以 importlib 載入，避免跨程序傳遞模組物件
+MARKET_MODULES = {
+    'tw': 'downloader_tw', 'us': 'downloader_us', 'cn': 'downloader_cn',
+    'hk': 'downloader_hk', 'jp': 'downloader_jp', 'kr': 'downloader_kr'
+}
+
+# 設定預設下載區間
+DEFAULT_START = "2024-01-01"
+# 💡 空閒頁超過 25% 才整檔 VACUUM，其餘以 incremental_vacuum 回收 (與 downloader_base 相同門檻)
+VACUUM_FREELIST_RATIO = 0.25
+
+def run_market(m, folder_ids=None):
+    """單一市場的完整流程 (雲端快取 → 增量下載 → 特徵工程 → 回傳雲端)，回傳摘要 dict
+    - folder_ids: 主程序預先取得的雲端資料夾 {檔名: file_id}，未提供時於本程序列出一次"""
+    db_file = f"{m}_stock_warehouse.db"
+    default_end = (datetime.now() + timedelta(days=1)).strftime("%Y-%m-%d")
+    summary = {"market": m, "synced": False, "uploaded": False}
+    print(f"\n--- 🚀 市場啟動: {m.upper()} ---")
+
+    # 💡 各子程序自行建立 Drive 連線 (httplib2 連線不可跨程序共用)
     service = get_drive_service()
+    if service and folder_ids is None:
+        folder_ids = list_folder(service)
 
-    # 設定預設下載區間
-    DEFAULT_START = "2024-01-01"
-    DEFAULT_END = (datetime.now() + timedelta(days=1)).strftime("%Y-%m-%d")
-
-    for m in markets_to_run:
-        db_file = f"{m}_stock_warehouse.db"
-        print(f"\n--- 🚀 市場啟動: {m.upper()} ---")
-
-        # 1. 下載雲端快取
-        has_cache = False
-        if service:
-            has_cache = download_db_from_drive(service, db_file)
-            if m == 'kr':
-                download_db_from_drive(service, "kr_list_all.csv")
-
-        # 2. 💡 計算增量更新日期 (快取核心邏輯)
-        last_date = get_db_last_date(db_file)
-        if last_date:
-            # 如果快取存在，從最後一天的隔天開始抓
-            actual_start = (pd.to_datetime(last_date) + timedelta(days=1)).strftime("%Y-%m-%d")
-            print(f"📦 偵測到快取數據，最後日期: {last_date}。將從 {actual_start} 開始增量下載。")
-            
-            # 如果計算出的開始日期已經大於等於明天，則無需重複下載
-            if actual_start >= DEFAULT_END:
-                print(f"✨ 數據已是最新，跳過 {m.upper()} 下載步驟。")
-                actual_start = None # 標記為不執行
-        else:
-            actual_start = DEFAULT_START
-            print(f"🆕 無可用快取，將執行完整下載 (起始日: {actual_start})")
-
-        # 3. 執行下載 (只有在需要更新時執行)
-        if actual_start:
-            target_module = module_map.get(m)
-            if target_module:
-                print(f"📡 正在抓取 {actual_start} ~ {DEFAULT_END} 的數據...")
-                target_module.run_sync(start_date=actual_start, end_date=DEFAULT_END)
-        
-        # 4. 執行特徵工程加工
-        if process_market_data and os.path.exists(db_file):
-            print(f"🧪 執行特徵工程加工...")
-            process_market_data(db_file)
+    # 1. 下載雲端快取
+    has_cache = False
+    if service:
+        has_cache = download_db_from_drive(service, db_file, folder_ids)
+        if m == 'kr':
+            download_db_from_drive(service, "kr_list_all.csv", folder_ids)
+
+    # 2. 💡 快取核心邏輯：全域 MAX(date) 只用來判斷是否整個市場都已最新；
+    #    實際起始日由各下載器以 SELECT symbol, MAX(date) ... GROUP BY symbol 逐檔決定，
+    #    落後的標的補齊自己的缺口，新上市標的則從 DEFAULT_START 開始
+    last_date = get_db_last_date(db_file)
+    run_needed = True
+    if last_date:
+        next_date = (pd.to_datetime(last_date) + timedelta(days=1)).strftime("%Y-%m-%d")
+        print(f"📦 [{m.upper()}] 偵測到快取數據，最後日期: {last_date}。各標的將從自身最後日期的隔天增量下載。")
         
-        # 5. 優化資料庫並回傳雲端
-        if service and os.path.exists(db_file):
-            print(f"🧹 優化資料庫並同步至雲端快取...")
-            try:
-                conn = sqlite3.connect(db_file)
-                conn.execute("VACUUM")
-                conn.close()
-                
-                # 使用改進後的上傳函數
-                if upload_db_to_drive(service, db_file):
-                    print(f"✅ {db_file} 雲端快取更新成功!")
-                else:
-                    print(f"⚠️ {db_file} 雲端快取更新失敗，但本地檔案已儲存")
-                    
-            except Exception as e:
-                print(f"❌ 資料庫優化或上傳失敗: {e}")
+        # 如果計算出的開始日期已經大於等於明天，則無需重複下載
+        if next_date >= default_end:
+            print(f"✨ 數據已是最新，跳過 {m.upper()} 下載步驟。")
+            run_needed = False
+    else:
+        print(f"🆕 [{m.upper()}] 無可用快取，將執行完整下載 (起始日: {DEFAULT_START})")
+
+    # 3. 執行下載 (只有在需要更新時執行)
+    if run_needed:
+        target_module = importlib.import_module(MARKET_MODULES[m])
+        print(f"📡 [{m.upper()}] 正在抓取 ~ {default_end} 的數據...")
+        summary["result"] = target_module.run_sync(start_date=DEFAULT_START, end_date=default_end)
+        summary["synced"] = True
+
+    # 💡 雲端快取已是最新且本次沒有寫入任何新列：特徵表、資料庫檔案都不會改變，
+    #    直接略過特徵工程、VACUUM 與上傳
+    inserted_rows = (summary.get("result") or {}).get("inserted_rows", 0) if run_needed else 0
+    if has_cache and inserted_rows == 0:
+        print(f"✨ [{m.upper()}] 本次無新增資料，略過特徵工程與雲端上傳。")
+        return summary
+    
+    # 4. 執行特徵工程加工
+    if process_market_data and os.path.exists(db_file):
+        print(f"🧪 [{m.upper()}] 執行特徵工程加工...")
+        process_market_data(db_file)
+    
+    # 5. 優化資料庫並回傳雲端
+    if service and os.path.exists(db_file):
+        print(f"🧹 [{m.upper()}] 優化資料庫並同步至雲端快取...")
+        try:
+            # 💡 套用與下載器相同的 WAL / 大快取 PRAGMA；open_db 為 autocommit 模式，VACUUM 不會落在交易內
+            conn = open_db(db_file)
+            # 💡 VACUUM 會重寫整個檔案，只在空閒頁過多或舊檔尚未啟用增量回收時執行；
+            #    否則以 incremental_vacuum 釋放空閒頁，再把 WAL 併回主檔 (上傳的是 .db 本體)
+            page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+            freelist = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            auto_vacuum = conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+            page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+            compacted = None
+            if auto_vacuum != 2 or page_size != PAGE_SIZE:
+                # 舊資料庫 auto_vacuum=NONE 或 4KB 頁：設定後需一次 VACUUM 才會轉換 (WAL 下僅 VACUUM INTO 能改 page_size)
+                print(f"🧹 [{m.upper()}] 轉換為增量回收 + {PAGE_SIZE // 1024}KB 頁 (目前 auto_vacuum={auto_vacuum}, page_size={page_size})，執行一次 VACUUM")
+                conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+                conn.execute(f"PRAGMA page_size = {PAGE_SIZE}")
+                compacted = vacuum_into(conn, db_file)
+            elif page_count and freelist / page_count > VACUUM_FREELIST_RATIO:
+                print(f"🧹 [{m.upper()}] 空閒頁 {freelist}/{page_count}，執行 VACUUM")
+                compacted = vacuum_into(conn, db_file)
+            else:
+                conn.execute("PRAGMA incremental_vacuum(10000)").fetchall()
+            # 💡 stock_analysis 剛重新寫入，順帶更新查詢統計 (僅分析有需要的表，成本極低)
+            conn.execute("PRAGMA optimize")
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            conn.close()
+            if compacted:
+                # 連線關閉 (WAL 已併回並移除) 後才以壓縮檔原子替換原檔
+                os.replace(compacted, db_file)
+            
+            # 使用改進後的上傳函數
+            if upload_db_to_drive(service, db_file, folder_ids=folder_ids):
+                summary["uploaded"] = True
+                print(f"✅ {db_file} 雲端快取更新成功!")
+            else:
+                print(f"⚠️ {db_file} 雲端快取更新失敗，但本地檔案已儲存")
                 
-                # 嘗試簡單備份
+        except Exception as e:
+            print(f"❌ 資料庫優化或上傳失敗: {e}")
+            
+            # 嘗試簡單備份
+            try:
+                backup_file = f"{db_file}.backup"
+                # 💡 以 SQLite 線上備份 API 複製：包含尚未併回主檔的 WAL 內容，也不會複製到寫入中途的頁面
+                src, dst = sqlite3.connect(db_file), sqlite3.connect(backup_file)
+                try:
+                    src.backup(dst)
+                finally:
+                    dst.close()
+                    src.close()
+                print(f"📋 已建立本地備份: {backup_file}")
+            except:
+                print("⚠️ 無法建立本地備份")
+
+    return summary
+
+def main():
+    target_market = sys.argv[1].lower() if len(sys.argv) > 1 else 'all'
+    markets_to_run = [target_market] if target_market in MARKET_MODULES else list(MARKET_MODULES.keys())
+
+    # 💡 雲端資料夾清單只列一次，{檔名: file_id} 對照表交給各市場共用
+    service = get_drive_service()
+    folder_ids = list_folder(service) if service else None
+    run = partial(run_market, folder_ids=folder_ids)
+
+    # 💡 各市場使用獨立的資料庫檔案與 API，彼此無相依，以多程序並行執行：
+    #    總耗時約等於最慢的單一市場，而非所有市場相加。
+    #    (特徵工程為 CPU 密集，使用程序而非執行緒才不會被 GIL 串行化)
+    all_summaries = []
+    if len(markets_to_run) == 1:
+        all_summaries.append(run(markets_to_run[0]))
+    else:
+        with mp.Pool(min(6, len(markets_to_run))) as pool:
+            pending = {m: pool.apply_async(run, (m,)) for m in markets_to_run}
+            # 單一市場失敗只記錄錯誤，不中斷其他市場
+            for m, res in pending.items():
                 try:
-                    backup_file = f"{db_file}.backup"
-                    import shutil
-                    shutil.copy2(db_file, backup_file)
-                    print(f"📋 已建立本地備份: {backup_file}")
-                except:
-                    print("⚠️ 無法建立本地備份")
+                    all_summaries.append(res.get())
+                except Exception as e:
+                    print(f"❌ {m.upper()} 市場處理失敗: {e}")
+                    all_summaries.append({"market": m, "synced": False, "uploaded": False, "error": str(e)})
 
+    for s in all_summaries:
+        status = f"❌ {s['error']}" if s.get('error') else f"下載: {'✅' if s['synced'] else '⏭️'} | 上傳: {'✅' if s['uploaded'] else '—'}"
+        print(f"📋 {s['market'].upper()} | {status}")
     print("\n✅ 所有選定市場處理完畢。")
 
 if __name__ == "__main__":
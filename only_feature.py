@@ -23,7 +23,8 @@ def run_remote_process(market):
         # 2. 執行特徵工程 (processor.py)
         if os.path.exists(db_file):
             print(f"🧪 開始對 {market.upper()} 執行資料清洗與特徵加工...")
-            process_market_data(db_file)
+            # 💡 手動加工通常是為了套用修改後的指標公式，整表重算而非增量更新
+            process_market_data(db_file, full_rebuild=True)
             
             # 3. 加工完後，傳回雲端覆蓋舊檔
             print(f"📤 將加工後的數據庫同步回雲端...")
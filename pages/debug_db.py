@@ -16,18 +16,18 @@ if not os.path.exists(DB_NAME):
 else:
     st.success(f"✅ 偵測到資料庫檔案: {DB_NAME}")
     
-    # 建立連線
-    conn = sqlite3.connect(DB_NAME)
+    # 💡 以唯讀模式開啟：頁面絕不會寫入資料庫；WAL 模式下仍會讀取 -wal 內尚未 checkpoint 的資料 (需要 -shm)
+    conn = sqlite3.connect(f"file:{DB_NAME}?mode=ro", uri=True)
     
     # --- 1. 檢查所有表格 ---
     st.header("1. 資料表清單 (Tables)")
-    tables = pd.read_sql("SELECT name FROM sqlite_master WHERE type='table'", conn)
-    st.table(tables)
+    table_names = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")]
+    st.table({"name": table_names})
     
-    if not tables.empty:
+    if table_names:
         # 讓使用者選擇要檢查的表格 (預設為 stock_analysis)
-        target_table = st.selectbox("選擇要診斷的表格", tables['name'].tolist(), 
-                                     index=tables['name'].tolist().index('stock_analysis') if 'stock_analysis' in tables['name'].tolist() else 0)
+        target_table = st.selectbox("選擇要診斷的表格", table_names, 
+                                     index=table_names.index('stock_analysis') if 'stock_analysis' in table_names else 0)
         
         st.divider()
         
@@ -47,12 +47,11 @@ else:
         col1, col2, col3 = st.columns(3)
         
         try:
-            total_rows = pd.read_sql(f"SELECT COUNT(*) as count FROM {target_table}", conn).iloc[0]['count']
+            # 💡 只取幾個純量，直接用 cursor 一次查詢，不必建立 DataFrame
+            total_rows, start, end = conn.execute(f"SELECT COUNT(*), MIN(date), MAX(date) FROM {target_table}").fetchone()
             col1.metric("總列數 (Rows)", f"{total_rows:,}")
-            
-            date_range = pd.read_sql(f"SELECT MIN(date) as start, MAX(date) as end FROM {target_table}", conn)
-            col2.metric("資料起點", str(date_range.iloc[0]['start']))
-            col3.metric("資料終點 (最新日期)", str(date_range.iloc[0]['end']))
+            col2.metric("資料起點", str(start))
+            col3.metric("資料終點 (最新日期)", str(end))
         except:
             st.warning("無法讀取數據統計，請確認欄位名稱是否包含 'date'")
 
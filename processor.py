@@ -2,87 +2,243 @@
 import sqlite3
 import pandas as pd
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 
-def process_market_data(db_path):
-    conn = sqlite3.connect(db_path)
-    # 1. 讀取數據
-    query = "SELECT * FROM stock_prices"
-    df = pd.read_sql(query, conn)
-    df['date'] = pd.to_datetime(df['date'])
+from downloader_base import open_db
+
+# 💡 與 pandas.to_sql 相同的欄位型別對應 (依 dtype.kind)，其餘一律 TEXT
+SQL_TYPES = {'f': 'REAL', 'i': 'INTEGER', 'u': 'INTEGER', 'b': 'INTEGER', 'M': 'TIMESTAMP'}
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# 💡 增量更新：從「有新價格的標的中最舊的特徵日期」回推 REDO_DAYS 天開始重寫 (未來 20 日報酬會隨新資料改變)，
+#    並往前多讀 WARMUP_DAYS 天 (至少涵蓋當年第一個交易日) 讓 MA60 / EMA / YTD 與全量計算一致；
+#    起點比最新特徵日期早超過 MAX_REDO_DAYS 天時，增量已無優勢，直接全量重建
+REDO_DAYS = 45
+WARMUP_DAYS = 400
+MAX_REDO_DAYS = 365
+ANALYSIS_INDEX = "CREATE INDEX IF NOT EXISTS idx_analysis ON stock_analysis (symbol, date)"
+
+def table_rows(df):
+    # 💡 逐欄 .tolist() 轉為 Python 原生型別再 zip 成列，NaN 綁定時由 SQLite 存為 NULL
+    columns = [df[c].dt.strftime(DATE_FORMAT).tolist() if df[c].dtype.kind == 'M' else df[c].tolist()
+               for c in df.columns]
+    return zip(*columns)
+
+def replace_table(conn, table, df, indexes=()):
+    """取代 to_sql(if_exists='replace')：DROP / CREATE / 單一預備語句 executemany / 建索引全在同一個交易內完成
+    (日期沿用 to_sql 的 'YYYY-MM-DD HH:MM:SS' 字串格式，儀表板的查詢條件不受影響)"""
+    col_defs = ", ".join(f'"{c}" {SQL_TYPES.get(df[c].dtype.kind, "TEXT")}' for c in df.columns)
+    placeholders = ", ".join("?" * len(df.columns))
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute(f'DROP TABLE IF EXISTS "{table}"')
+        conn.execute(f'CREATE TABLE "{table}" ({col_defs})')
+        conn.executemany(f'INSERT INTO "{table}" VALUES ({placeholders})', table_rows(df))
+        # 💡 資料寫完才建索引 (一次排序建樹)，且與寫入同屬一個交易，只需一次提交
+        for sql in indexes:
+            conn.execute(sql)
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+def refresh_rows(conn, table, df, since):
+    """增量寫入：同一個交易內只刪除本次重算標的 since (含) 之後的舊列，再寫入重新計算的列"""
+    placeholders = ", ".join("?" * len(df.columns))
+    since = since.strftime(DATE_FORMAT)
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        # 💡 依 (symbol, date) 索引逐檔刪除，未重算的標的一列都不動
+        conn.executemany(f'DELETE FROM "{table}" WHERE symbol = ? AND date >= ?',
+                         [(symbol, since) for symbol in df['symbol'].unique()])
+        conn.executemany(f'INSERT INTO "{table}" VALUES ({placeholders})', table_rows(df))
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+def get_analysis_state(conn):
+    """回傳既有 stock_analysis 的 (欄位清單, {symbol: 最後日期})；表不存在或為空時回傳 (None, None)"""
+    try:
+        rows = conn.execute("SELECT symbol, MAX(date) FROM stock_analysis GROUP BY symbol").fetchall()
+    except sqlite3.OperationalError:
+        return None, None
+    if not rows:
+        return None, None
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(stock_analysis)")]
+    symbols, dates = zip(*rows)
+    return columns, dict(zip(symbols, pd.to_datetime(list(dates))))
+
+def plan_refresh(analysis_last, price_state):
+    """依各標的狀態決定增量重算起點；回推過久時回傳 None，改為全量重建
+    - 只看價格新於其特徵最後日期的標的 (落後補抓的標的會把起點往前拉，已下市的標的不影響)"""
+    newest = max(analysis_last.values())
+    start = newest
+    for symbol, (last_price, _) in price_state.items():
+        done = analysis_last.get(symbol)
+        if done is not None and last_price > done:
+            start = min(start, done)
+    redo_from = start.normalize() - pd.Timedelta(days=REDO_DAYS)
+    if newest - redo_from > pd.Timedelta(days=MAX_REDO_DAYS):
+        return None
+    return redo_from
+
+def get_price_state(conn):
+    """一次 GROUP BY 查詢取得各標的 {symbol: (最後日期, 總筆數)}"""
+    rows = conn.execute("SELECT symbol, MAX(date), COUNT(*) FROM stock_prices GROUP BY symbol").fetchall()
+    # 💡 pd.Timestamp 可直接解析 YYYYMMDD 整數字串，也相容舊版 TEXT 日期
+    return {symbol: (pd.Timestamp(str(last)), count) for symbol, last, count in rows}
+
+def process_market_data(db_path, full_rebuild=False):
+    """計算技術指標並寫入 stock_analysis
+    - full_rebuild=False 且已有 stock_analysis 時只重算最近 REDO_DAYS 天，其餘列沿用"""
+    # 💡 與下載器相同的 WAL / synchronous=NORMAL / 大快取設定，整表改寫不再逐頁 fsync 回滾日誌
+    conn = open_db(db_path)
+    existing_cols, analysis_last = (None, None) if full_rebuild else get_analysis_state(conn)
+    redo_from = None
+    if analysis_last is not None:
+        price_state = get_price_state(conn)
+        redo_from = plan_refresh(analysis_last, price_state)
+        if redo_from is None:
+            print(f"ℹ️ {db_path} 有標的落後超過 {MAX_REDO_DAYS} 天，改為全量重建")
+    # 1. 讀取數據 (明確列出所需欄位，不使用 SELECT *)
+    query = "SELECT date, symbol, open, high, low, close, volume FROM stock_prices"
+    params = ()
+    if redo_from is not None:
+        load_from = min(pd.Timestamp(redo_from.year, 1, 1), redo_from - pd.Timedelta(days=WARMUP_DAYS))
+        query += " WHERE date >= ?"
+        params = (int(load_from.strftime('%Y%m%d')),)
+    df = pd.read_sql(query, conn, params=params)
+    if redo_from is not None:
+        # 💡 新標的需寫入全部歷史：若其歷史早於讀取區間則增量結果不完整，改為全量重建
+        window = df['symbol'].value_counts()
+        partial = [s for s, (_, count) in price_state.items()
+                   if s not in analysis_last and count >= 60 and window.get(s, 0) < count]
+        if partial:
+            conn.close()
+            return process_market_data(db_path, full_rebuild=True)
+    # 各市場的日期以 YYYYMMDD 整數儲存
+    if pd.api.types.is_integer_dtype(df['date']):
+        # 💡 以整數運算拆出年月日直接組成日期，省去逐列轉字串再解析
+        d = df['date'].to_numpy()
+        df['date'] = pd.to_datetime(pd.DataFrame({'year': d // 10000, 'month': d // 100 % 100, 'day': d % 100}))
+    else:
+        df['date'] = pd.to_datetime(df['date'])
     df = df.sort_values(['symbol', 'date'])
 
-    processed_list = []
-    
     # 2. 分組計算指標
-    for symbol, group in df.groupby('symbol'):
-        group = group.copy().sort_values('date')
-        
-        # --- 🟢 資料清洗 (Data Cleaning) ---
-        # A. 計算單日漲跌幅，用來偵測異常值 (例如 8476 異常的 300% 漲幅)
-        group['daily_change'] = group['close'].pct_change()
-        
-        # B. 剔除異常數據：如果單日漲幅或跌幅超過 50% 且成交量異常，
-        # 在這裡我們可以選擇修正它或標記它。為了穩定性，我們將極端異常值平滑化
-        # (這裡以超過 60% 為例，避免誤刪除權息後的真實波動)
-        group.loc[abs(group['daily_change']) > 0.6, 'close'] = np.nan
-        group['close'] = group['close'].ffill() # 用前一天價格填充異常值
-        
-        if len(group) < 60: continue 
-
-        # --- A. 指標計算 (MA, MACD, KD) ---
-        group['ma20'] = group['close'].rolling(window=20).mean()
-        group['ma60'] = group['close'].rolling(window=60).mean()
-        group['ma20_slope'] = (group['ma20'].diff(3) / 3).round(4) # 補上 round
-        group['ma60_slope'] = (group['ma60'].diff(3) / 3).round(4)
-        
-        # --- 增加特徵斜率計算 ---
-        group['ma60_slope'] = (group['ma60'].diff(3) / 3).round(4)
-        ema12 = group['close'].ewm(span=12, adjust=False).mean()
-        ema26 = group['close'].ewm(span=26, adjust=False).mean()
-        group['macd'] = (ema12 - ema26)
-        group['macds'] = group['macd'].ewm(span=9, adjust=False).mean()
-        group['macdh'] = (group['macd'] - group['macds'])
-        group['macdh_slope'] = (group['macdh'].diff(1)).round(4) # 柱狀體變化速度
-        low_min = group['low'].rolling(window=9).min()
-        high_max = group['high'].rolling(window=9).max()
-        # 避免分母為 0
-        denominator = high_max - low_min + 1e-9
-        rsv = 100 * (group['close'] - low_min) / denominator
-        group['k'] = rsv.ewm(com=2, adjust=False).mean()
-        group['d'] = group['k'].ewm(com=2, adjust=False).mean()
-        group['kd_gold'] = ((group['k'] > group['d']) & (group['k'].shift(1) <= group['d'].shift(1))).astype(int)
-
-        # --- B. 底部背離 ---
-        lookback = 10
-        price_low_new = group['close'] < group['close'].shift(1).rolling(window=lookback).min()
-        group['macd_bottom_div'] = ((price_low_new) & (group['macdh'] > group['macdh'].shift(1).rolling(window=lookback).min())).astype(int)
-        group['kd_bottom_div'] = ((price_low_new) & (group['k'] > group['k'].shift(1).rolling(window=lookback).min())).astype(int)
-
-        # --- 🔵 年度報酬對帳 (Annual Performance Logic) ---
-        # 計算該日期相對於該年「第一筆交易日」的漲跌幅 (實測漲幅)
-        group['year'] = group['date'].dt.year
-        group['year_start_price'] = group.groupby('year')['close'].transform('first')
-        group['ytd_ret'] = ((group['close'] - group['year_start_price']) / group['year_start_price'] * 100).round(2)
-
-        # --- C. 未來報酬 (最大漲跌幅 % ) ---
-        windows = {'1-5': (1, 5), '6-10': (6, 10), '11-20': (11, 20)}
-        for label, (s, e) in windows.items():
-            f_high = group['high'].shift(-s).rolling(window=(e-s+1)).max()
-            group[f'up_{label}'] = ((f_high / group['close'] - 1) * 100).round(2)
-            
-            f_low = group['low'].shift(-s).rolling(window=(e-s+1)).min()
-            group[f'down_{label}'] = ((f_low / group['close'] - 1) * 100).round(2)
-
-        processed_list.append(group)
+    # 💡 整張表只排序一次，所有指標以 groupby 的 rolling / ewm / shift 一次算完全部標的：
+    #    由 Cython 核心依各組邊界計算，取代逐檔 Python 迴圈 + .copy() + pd.concat
+    df = df.reset_index(drop=True)
+    # 💡 分組鍵先轉成整數代碼一次，後續三十餘次 groupby 不必每次重新對字串欄位做 factorize
+    keys = df['symbol'].factorize()[0]
+
+    def by_symbol(s):
+        return s.groupby(keys, sort=False)
+
+    def rolling(s, window, how):
+        return getattr(by_symbol(s).rolling(window=window), how)().droplevel(0)
+
+    def ewm(s, **kwargs):
+        return by_symbol(s).ewm(adjust=False, **kwargs).mean().droplevel(0)
+
+    # --- 🟢 資料清洗 (Data Cleaning) ---
+    # A. 計算單日漲跌幅，用來偵測異常值 (例如 8476 異常的 300% 漲幅)
+    df['daily_change'] = by_symbol(df['close']).pct_change()
+
+    # B. 剔除異常數據：如果單日漲幅或跌幅超過 50% 且成交量異常，
+    # 在這裡我們可以選擇修正它或標記它。為了穩定性，我們將極端異常值平滑化
+    # (這裡以超過 60% 為例，避免誤刪除權息後的真實波動)
+    df.loc[abs(df['daily_change']) > 0.6, 'close'] = np.nan
+    df['close'] = by_symbol(df['close']).ffill() # 用前一天價格填充異常值
+
+    # 資料不足 60 筆的標的不計算
+    keep = by_symbol(df['close']).transform('size').to_numpy() >= 60
+    df = df[keep].reset_index(drop=True)
+    keys = keys[keep]
+    # 各列在所屬標的內的位置與該標的總列數 (整欄 numpy 運算時用來遮掉跨標的的比較)
+    pos = by_symbol(df['close']).cumcount().to_numpy()
+    size = by_symbol(df['close']).transform('size').to_numpy()
+
+    def cross_up(a, b):
+        # 💡 今日 a > b 且昨日 a <= b；直接比較相鄰的 ndarray 元素，不必建立分組位移序列，
+        #    各標的第一列沒有前一日，一律為 0
+        a, b = a.to_numpy(), b.to_numpy()
+        out = np.zeros(len(a), dtype=bool)
+        out[1:] = (a[1:] > b[1:]) & (a[:-1] <= b[:-1])
+        out[pos == 0] = False
+        return out.astype(int)
+
+    # --- A. 指標計算 (MA, MACD, KD) ---
+    df['ma20'] = rolling(df['close'], 20, 'mean')
+    df['ma60'] = rolling(df['close'], 60, 'mean')
+    df['ma20_slope'] = (by_symbol(df['ma20']).diff(3) / 3).round(4) # 補上 round
+    df['ma60_slope'] = (by_symbol(df['ma60']).diff(3) / 3).round(4)
+
+    # --- 增加特徵斜率計算 ---
+    ema12 = ewm(df['close'], span=12)
+    ema26 = ewm(df['close'], span=26)
+    df['macd'] = (ema12 - ema26)
+    df['macds'] = ewm(df['macd'], span=9)
+    df['macdh'] = (df['macd'] - df['macds'])
+    df['macdh_slope'] = (by_symbol(df['macdh']).diff(1)).round(4) # 柱狀體變化速度
+    low_min = rolling(df['low'], 9, 'min')
+    high_max = rolling(df['high'], 9, 'max')
+    # 避免分母為 0
+    denominator = high_max - low_min + 1e-9
+    rsv = 100 * (df['close'] - low_min) / denominator
+    df['k'] = ewm(rsv, com=2)
+    df['d'] = ewm(df['k'], com=2)
+    df['kd_gold'] = cross_up(df['k'], df['d'])
+
+    # --- B. 底部背離 ---
+    lookback = 10
+    price_low_new = df['close'] < rolling(by_symbol(df['close']).shift(1), lookback, 'min')
+    df['macd_bottom_div'] = ((price_low_new) & (df['macdh'] > rolling(by_symbol(df['macdh']).shift(1), lookback, 'min'))).astype(int)
+    df['kd_bottom_div'] = ((price_low_new) & (df['k'] > rolling(by_symbol(df['k']).shift(1), lookback, 'min'))).astype(int)
+
+    # --- 🔵 年度報酬對帳 (Annual Performance Logic) ---
+    # 計算該日期相對於該年「第一筆交易日」的漲跌幅 (實測漲幅)
+    df['year'] = df['date'].dt.year
+    df['year_start_price'] = df['close'].groupby([keys, df['year']], sort=False).transform('first')
+    df['ytd_ret'] = ((df['close'] - df['year_start_price']) / df['year_start_price'] * 100).round(2)
+
+    # --- C. 未來報酬 (最大漲跌幅 % ) ---
+    # 💡 等同各組 shift(-s).rolling(w)：整欄以 sliding_window_view 一次取視窗極值，
+    #    再遮掉視窗跨出該標的首尾的列，不必為每個視窗建立位移序列與分組 rolling 物件
+    def forward_extreme(values, s, w, reduce):
+        out = np.full(len(values), np.nan)
+        rows = np.flatnonzero((pos >= w - 1) & (pos + s < size))
+        if len(rows):
+            out[rows] = reduce(sliding_window_view(values, w), axis=1)[rows - w + 1 + s]
+        return pd.Series(out, index=df.index)
+
+    high, low = df['high'].to_numpy(), df['low'].to_numpy()
+    windows = {'1-5': (1, 5), '6-10': (6, 10), '11-20': (11, 20)}
+    for label, (s, e) in windows.items():
+        f_high = forward_extreme(high, s, e-s+1, np.max)
+        df[f'up_{label}'] = ((f_high / df['close'] - 1) * 100).round(2)
+
+        f_low = forward_extreme(low, s, e-s+1, np.min)
+        df[f'down_{label}'] = ((f_low / df['close'] - 1) * 100).round(2)
 
     # 3. 寫回資料庫
-    df_final = pd.concat(processed_list)
-    
     # 清除中間計算用的欄位以保持整潔
-    cols_to_drop = ['daily_change', 'year_start_price']
-    df_final = df_final.drop(columns=[c for c in cols_to_drop if c in df_final.columns])
+    df_final = df.drop(columns=['daily_change', 'year_start_price'])
     
-    df_final.to_sql('stock_analysis', conn, if_exists='replace', index=False)
-    conn.execute("CREATE INDEX IF NOT EXISTS idx_analysis ON stock_analysis (symbol, date)")
+    if redo_from is None:
+        replace_table(conn, 'stock_analysis', df_final, indexes=[ANALYSIS_INDEX])
+    else:
+        # 舊表中在 redo_from 之後仍有價格的標的都必須重算；讀取區間內不足 60 筆而被略過時改為全量重建
+        computed = set(df_final['symbol'].unique())
+        missing = [s for s, (last_price, _) in price_state.items()
+                   if s in analysis_last and last_price >= redo_from and s not in computed]
+        if list(df_final.columns) != existing_cols or missing:
+            # 欄位定義已變更 (如新增指標) 或讀取區間不足，舊表無法沿用，改為全量重建
+            conn.close()
+            return process_market_data(db_path, full_rebuild=True)
+        # 本次才滿 60 筆的新標的不在舊表內，需寫入其全部歷史
+        recent = (df_final['date'] >= redo_from) | ~df_final['symbol'].isin(list(analysis_last))
+        refresh_rows(conn, 'stock_analysis', df_final[recent], redo_from)
     conn.close()
     print(f"✅ {db_path} 特徵工程完成 (含資料清洗與 YTD 實測漲幅)")